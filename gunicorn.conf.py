@@ -0,0 +1,21 @@
+# Configuration gunicorn (lue automatiquement depuis le répertoire courant) :
+#   gunicorn main:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+
+# Application construite une fois dans le processus parent : les workers
+# démarrent par fork, sans refaire imports et vérification du schéma.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def post_fork(server, worker):
+    # Les connexions ouvertes par le parent (vérification du schéma) ne doivent
+    # pas être partagées : chaque worker repart d'un pool vide.
+    if preload_app:
+        from main import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)
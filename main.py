@@ -1,37 +1,119 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, render_template, render_template_string, request, redirect, url_for, flash, abort, jsonify
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash, abort, jsonify, make_response, g, has_request_context, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import text
-import os, pytz
+from markupsafe import Markup
+from sqlalchemy import text, func, and_, or_, insert, update, delete, event
+from sqlalchemy.orm import undefer_group, joinedload, selectinload, validates
+from sqlalchemy.exc import IntegrityError
+import base64, bisect, csv, hashlib, io, json, math, os, re, secrets, threading, unicodedata, pytz
+import time as _time
 from datetime import datetime, timedelta, time, date
-
-# --- Guides: markdown + sanitisation HTML ---
-import markdown
-import bleach
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as DelaiDepasse
 
 # ---------------------------------------------------------------------
 # Utilitaires de date/heure et règles métier
 # ---------------------------------------------------------------------
-def get_jour_de_jeu():
-    now = datetime.now()
-    heure = now.hour
-    if heure < 3:
-        return (now - timedelta(days=1)).date()
-    elif 3 <= heure < 5:
-        return None  # période de maintenance
-    else:
-        return now.date()
-
 def parse_hhmm(s): 
     h, m = s.split(":")
     return time(int(h), int(m))
 
+EtatJeu = namedtuple("EtatJeu", "jour bloque jour_suivant")
+
+class HorlogeJeu:
+    """Horloge du jeu dans un fuseau donné.
+
+    Le jour de jeu bascule à la fin du créneau bloqué (BLOCK_TO) ; pendant le
+    créneau, `jour` reste celui qui se termine et `jour_suivant` celui qui
+    s'ouvrira. Les bornes sont calculées une fois par jour civil et l'état est
+    mémorisé jusqu'à la prochaine borne. `maintenant` permet d'injecter une
+    horloge factice (voir manage.py check-horloge).
+    """
+
+    def __init__(self, tz, debut, fin, maintenant=None):
+        self.tz = tz
+        self.debut, self.fin = parse_hhmm(debut), parse_hhmm(fin)
+        self.maintenant = maintenant or (lambda: datetime.now(tz))
+        self._bornes = {}
+        self._memo = None  # (depuis, jusqua, EtatJeu)
+        self._lock = threading.Lock()
+
+    def bornes(self, jour):
+        # Début et fin (instants localisés) du créneau qui commence le jour civil `jour`
+        b = self._bornes.get(jour)
+        if b is None:
+            fin_jour = jour if self.debut < self.fin else jour + timedelta(days=1)
+            b = (
+                self._localiser(datetime.combine(jour, self.debut), debut=True),
+                self._localiser(datetime.combine(fin_jour, self.fin), debut=False),
+            )
+            if len(self._bornes) > 16:
+                self._bornes.clear()
+            self._bornes[jour] = b
+        return b
+
+    def _localiser(self, dt, debut):
+        try:
+            return self.tz.localize(dt, is_dst=None)
+        except pytz.AmbiguousTimeError:
+            # Heure répétée (passage à l'heure d'hiver) : le créneau couvre les deux passages
+            return self.tz.localize(dt, is_dst=debut)
+        except pytz.NonExistentTimeError:
+            # Heure sautée (passage à l'heure d'été) : on retient l'instant du saut
+            while True:
+                dt += timedelta(minutes=1)
+                try:
+                    return self.tz.localize(dt, is_dst=None)
+                except pytz.NonExistentTimeError:
+                    pass
+
+    def _calculer(self, now):
+        civil = now.astimezone(self.tz).date()
+        creneaux = [self.bornes(civil + timedelta(days=k)) for k in (-2, -1, 0, 1)]
+        derniere_fin = max(f for _, f in creneaux if f <= now)
+        prochaine_fin = min(f for _, f in creneaux if f > now)
+        bloque = any(d <= now < f for d, f in creneaux)
+        passees = [x for c in creneaux for x in c if x <= now]
+        depuis = max(passees) if passees else now
+        jusqua = min(x for c in creneaux for x in c if x > now)
+        etat = EtatJeu(derniere_fin.date(), bloque, prochaine_fin.date())
+        return depuis, jusqua, etat
+
+    def etat(self):
+        now = self.maintenant()
+        memo = self._memo
+        if memo is None or not (memo[0] <= now < memo[1]):
+            with self._lock:
+                memo = self._memo = self._calculer(now)
+        return memo[2]
+
+    def jour(self):
+        return self.etat().jour
+
+def etat_jeu():
+    # Figé pour la durée d'une requête : jour et blocage restent cohérents entre eux
+    if not has_request_context():
+        return horloge.etat()
+    if "etat_jeu" not in g:
+        g.etat_jeu = horloge.etat()
+    return g.etat_jeu
+
+def get_jour_de_jeu():
+    etat = etat_jeu()
+    return None if etat.bloque else etat.jour  # None : période de maintenance
+
 def is_blocked_now():
-    now = datetime.now(TZ).time()
-    start, end = parse_hhmm(BLOCK_FROM), parse_hhmm(BLOCK_TO)
-    return start <= now < end if start < end else (now >= start or now < end)
+    return etat_jeu().bloque
+
+def normaliser_nom(nom):
+    # Forme de recherche : sans accents, en minuscules, apostrophes unifiées
+    nom = unicodedata.normalize("NFKD", nom or "")
+    nom = "".join(c for c in nom if not unicodedata.combining(c))
+    return " ".join(nom.lower().replace("’", "'").split())
 
 def count_lines(txt): 
     return len([ln for ln in (txt or "").splitlines() if ln.strip()])
@@ -47,6 +129,55 @@ def require_prevot_or_admin():
     if role not in ("prevot", "admin", "superadmin"):
         abort(403)
 
+# ---------------------------------------------------------------------
+# Mots de passe : politique de hachage et vérification hors du thread de requête
+# ---------------------------------------------------------------------
+# Méthode werkzeug : "scrypt" (défaut), "scrypt:16384:8:1", "pbkdf2:sha256:600000"...
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+LOGIN_WORKERS = int(os.getenv("LOGIN_WORKERS", "2"))
+LOGIN_FILE_MAX = int(os.getenv("LOGIN_FILE_MAX", "16"))
+LOGIN_ATTENTE = float(os.getenv("LOGIN_ATTENTE", "10"))
+
+@lru_cache(maxsize=1)
+def methode_hash_effective():
+    # Préfixe complet ("scrypt:32768:8:1") tel qu'écrit dans les hash de la politique courante
+    return generate_password_hash("", method=PASSWORD_HASH_METHOD).split("$", 1)[0]
+
+@lru_cache(maxsize=1)
+def hash_leurre():
+    # Vérifié quand l'identifiant est inconnu : même coût qu'un compte existant
+    return generate_password_hash(os.urandom(8).hex(), method=PASSWORD_HASH_METHOD)
+
+_pool_login = None
+_places_login = threading.BoundedSemaphore(LOGIN_FILE_MAX)
+_pool_login_lock = threading.Lock()
+
+def pool_login():
+    global _pool_login
+    with _pool_login_lock:
+        if _pool_login is None:
+            _pool_login = ThreadPoolExecutor(max_workers=LOGIN_WORKERS, thread_name_prefix="login")
+        return _pool_login
+
+def verifier_mot_de_passe(password_hash, password):
+    """Vérifie dans le pool borné (scrypt/pbkdf2 relâchent le GIL). Renvoie None
+    si la file est pleine ou l'attente dépassée : l'appelant répond 503. Un hash
+    illisible ou de méthode inconnue compte comme un échec de connexion."""
+    if not _places_login.acquire(blocking=False):
+        return None
+    try:
+        futur = pool_login().submit(check_password_hash, password_hash, password)
+        try:
+            return futur.result(timeout=LOGIN_ATTENTE)
+        except DelaiDepasse:
+            futur.cancel()
+            return None
+        except ValueError as e:
+            print("Hash de mot de passe illisible :", e)
+            return False
+    finally:
+        _places_login.release()
+
 # ---------------------------------------------------------------------
 # Connexion DB : normalise l'URL et force psycopg (psycopg3)
 # ---------------------------------------------------------------------
@@ -59,19 +190,38 @@ def pg_uri(uri: str) -> str:
         uri = uri.replace("postgresql://", "postgresql+psycopg://", 1)
     return uri
 
-app = Flask(__name__, static_folder="static")
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-secret")
+def options_moteur(uri: str) -> dict:
+    """SQLALCHEMY_ENGINE_OPTIONS depuis l'environnement (DB_POOL_*, DB_STATEMENT_TIMEOUT_MS,
+    DB_PREPARE_THRESHOLD). Les réglages de pool ne concernent que PostgreSQL."""
+    if not uri.startswith("postgresql"):
+        return {}
+    options = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        # Sous le délai de coupure des connexions inactives de l'hébergeur
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "280")),
+        # Vérifie la connexion à l'emprunt : pas d'erreur sur la première requête après une pause
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+    connect_args = {}
+    timeout_ms = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+    if timeout_ms:
+        connect_args["options"] = f"-c statement_timeout={timeout_ms}"
+    # psycopg3 prépare côté serveur une requête exécutée N fois sur une connexion
+    # (rapports par jour, brigands par nom...). "off" pour un pgbouncer en mode transaction.
+    seuil = os.getenv("DB_PREPARE_THRESHOLD", "2")
+    connect_args["prepare_threshold"] = None if seuil == "off" else int(seuil)
+    options["connect_args"] = connect_args
+    return options
+
 db_url = os.getenv("DATABASE_URL", "sqlite:///local.db")
-app.config["SQLALCHEMY_DATABASE_URI"] = pg_uri(db_url)
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=7)
-app.config["REMEMBER_COOKIE_DURATION"] = timedelta(days=365)
-app.config["REMEMBER_COOKIE_REFRESH_EACH_REQUEST"] = True
 
 TIMEZONE = os.getenv("TIMEZONE", "Europe/Paris")
 TZ = pytz.timezone(TIMEZONE)
 BLOCK_FROM = os.getenv("BLOCK_DEPOSITS_FROM", "03:00")
 BLOCK_TO = os.getenv("BLOCK_DEPOSITS_TO", "05:00")
+horloge = HorlogeJeu(TZ, BLOCK_FROM, BLOCK_TO)
 
 SITE_NAME = os.getenv("SITE_NAME", "Les Douanes du Sud")
 UI_BG_COLOR = os.getenv("UI_BG_COLOR", "#D5BC84")
@@ -80,27 +230,46 @@ REPORT_TITLE_COLOR = os.getenv("REPORT_TITLE_COLOR", "#162E5A")
 BUREAU_NAME = os.getenv("BUREAU_NAME", "Armagnac & Comminges")
 BUREAU_LOGO_URL = os.getenv("BUREAU_LOGO_URL", "")
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = "login"
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = "douanes.login"
 login_manager.login_message = None
+# Toutes les routes ; enregistré par create_app()
+bp = Blueprint("douanes", __name__)
 
 # ---------------------------------------------------------------------
 # Modèles
 # ---------------------------------------------------------------------
+def nouvelle_version():
+    # Entier positif sur 31 bits (colonne INTEGER), jamais 1 : valeur des comptes antérieurs au jeton
+    return secrets.randbelow(2**31 - 2) + 2
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), nullable=False, default="marechal")
     bureau = db.Column(db.String(120), nullable=True, default="Armagnac & Comminges")
+    # Jeton tiré au hasard à la création et à chaque modification du compte : invalide les
+    # instantanés de session, y compris ceux d'un compte supprimé dont l'id serait réattribué
+    version = db.Column(db.Integer, nullable=False, default=nouvelle_version)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+        self.version = nouvelle_version()
+
+    @validates("username", "role", "bureau")
+    def _renouveler_version(self, key, valeur):
+        self.version = nouvelle_version()
+        return valeur
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def doit_rehacher(self):
+        # Hash produit avec un autre coût que la politique courante
+        return self.password_hash.split("$", 1)[0] != methode_hash_effective()
+
 class Village(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nom = db.Column(db.String(120), unique=True, nullable=False)
@@ -108,19 +277,121 @@ class Village(db.Model):
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    report_date = db.Column(db.Date, default=date.today)
+    report_date = db.Column(db.Date, default=lambda: horloge.jour())
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     village = db.Column(db.String(120), nullable=False)
     tour_de_garde = db.Column(db.Boolean, default=True)
-    mem_visions = db.Column(db.Text, default="")
-    surveillance = db.Column(db.Text, default="")
-    flux = db.Column(db.Text, default="")
-    etrangers = db.Column(db.Text, default="")
-    ac_presence = db.Column(db.Text, default="")
-    armies_groups = db.Column(db.Text, default="")
-    villagers = db.Column(db.Text, default="")
-    moves = db.Column(db.Text, default="")
-    bbcode = db.Column(db.Text, default="")
+    # Colonnes Text différées : chargées uniquement à la lecture d'un rapport (voir_rapport)
+    mem_visions = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    surveillance = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    flux = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    etrangers = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    ac_presence = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    armies_groups = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    villagers = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    moves = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    bbcode = db.deferred(db.Column(db.Text, default=""), group="contenu")
+    # "pret", "en_attente" (rendu asynchrone à faire), "en_cours" ou "erreur"
+    rendu_statut = db.Column(db.String(20), nullable=False, default="pret", server_default="pret")
+    # Début du rendu « en_cours » : une reprise n'est possible qu'après RAPPORT_RENDU_RELANCE
+    rendu_debut = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_report_date_village", "report_date", "village"),
+        db.Index("ix_report_user_date", "user_id", "report_date"),
+    )
+
+class AgregatGarde(db.Model):
+    # Résumé par (village, jour) tenu à jour à chaque dépôt : tableau des gardes sans lire les Text
+    __tablename__ = "agregat_garde"
+    id = db.Column(db.Integer, primary_key=True)
+    report_date = db.Column(db.Date, nullable=False)
+    village = db.Column(db.String(120), nullable=False)
+    rapport_id = db.Column(db.Integer, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    tour_de_garde = db.Column(db.Boolean, default=True)
+    nb_rapports = db.Column(db.Integer, nullable=False, default=1)
+    nb_mem_visions = db.Column(db.Integer, nullable=False, default=0)
+    nb_surveillance = db.Column(db.Integer, nullable=False, default=0)
+    nb_flux = db.Column(db.Integer, nullable=False, default=0)
+    nb_etrangers = db.Column(db.Integer, nullable=False, default=0)
+    nb_ac_presence = db.Column(db.Integer, nullable=False, default=0)
+    nb_armies_groups = db.Column(db.Integer, nullable=False, default=0)
+    nb_villagers = db.Column(db.Integer, nullable=False, default=0)
+    nb_moves = db.Column(db.Integer, nullable=False, default=0)
+    # Noms connus relevés dans le rapport ayant une typologie (liste noire, couronne...)
+    nb_signales = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint("report_date", "village", name="uq_agregat_garde_date_village"),
+    )
+
+class ReportEntry(db.Model):
+    # Ligne « | » d'un rapport (mémoire et visions, surveillance), telle que lue au dépôt
+    __tablename__ = "report_entry"
+    id = db.Column(db.Integer, primary_key=True)
+    report_id = db.Column(db.Integer, db.ForeignKey("report.id"), nullable=False, index=True)
+    report_date = db.Column(db.Date, nullable=False)
+    village = db.Column(db.String(120), nullable=False)
+    section = db.Column(db.String(20), nullable=False)  # "mem_visions" ou "surveillance"
+    position = db.Column(db.Integer, nullable=False, default=0)
+    nom = db.Column(db.String(150), nullable=False)
+    nom_normalise = db.Column(db.String(150), nullable=False)
+    typologie = db.Column(db.String(20), nullable=False, default="")
+    organisation = db.Column(db.String(150), nullable=False, default="")
+    faits = db.Column(db.Text, nullable=False, default="")
+    statut = db.Column(db.String(80), nullable=False, default="")
+    est_ac = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.Index("ix_report_entry_nom_date", "nom_normalise", "report_date"),
+        db.Index("ix_report_entry_typologie_date", "typologie", "report_date"),
+    )
+
+class Observation(db.Model):
+    # Passage d'une personne dans un rapport : historique des déplacements (/api/sightings)
+    __tablename__ = "observation"
+    id = db.Column(db.Integer, primary_key=True)
+    nom = db.Column(db.String(150), nullable=False)
+    nom_normalise = db.Column(db.String(150), nullable=False)
+    report_date = db.Column(db.Date, nullable=False)
+    village = db.Column(db.String(120), nullable=False)
+    report_id = db.Column(db.Integer, db.ForeignKey("report.id"), nullable=False, index=True)
+    section = db.Column(db.String(20), nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_observation_nom_date_id", "nom_normalise", "report_date", "id"),
+    )
+
+class SyntheseJour(db.Model):
+    # Personne signalée un jour donné, fusionnée sur tous les villages (synthèse de douane)
+    __tablename__ = "synthese_jour"
+    id = db.Column(db.Integer, primary_key=True)
+    report_date = db.Column(db.Date, nullable=False)
+    nom = db.Column(db.String(150), nullable=False)
+    nom_normalise = db.Column(db.String(150), nullable=False)
+    typologie = db.Column(db.String(20), nullable=False, default="")
+    organisation = db.Column(db.String(150), nullable=False, default="")
+    statut = db.Column(db.String(80), nullable=False, default="")
+    # Villages où la personne a été relevée, JSON trié
+    villages = db.Column(db.Text, nullable=False, default="[]")
+
+    __table_args__ = (
+        db.UniqueConstraint("report_date", "nom_normalise", name="uq_synthese_jour_date_nom"),
+    )
+
+class DepotEnAttente(db.Model):
+    # Rapport reçu pendant la maintenance, enregistré à la réouverture
+    __tablename__ = "depot_en_attente"
+    id = db.Column(db.Integer, primary_key=True)
+    recu_le = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    jour_de_jeu = db.Column(db.Date, nullable=False)
+    donnees = db.Column(db.Text, nullable=False)
+    # "en_attente", "en_cours", "traite", "doublon" ou "erreur"
+    statut = db.Column(db.String(20), nullable=False, default="en_attente", index=True)
+    rapport_id = db.Column(db.Integer, nullable=True)
+    erreur = db.Column(db.Text, nullable=True)
 
 class Guide(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -129,6 +400,9 @@ class Guide(db.Model):
     content = db.Column(db.Text, default="")
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     updated_by = db.Column(db.String(120), default="system")
+    # HTML assaini, pré-rendu à l'enregistrement ; content_hash = empreinte du Markdown rendu
+    content_html = db.Column(db.Text, nullable=True)
+    content_hash = db.Column(db.String(40), nullable=True)
 
 class Organisation(db.Model):
     __tablename__ = "organisations"
@@ -146,125 +420,844 @@ class Brigand(db.Model):
     recherche_couronne = db.Column(db.Boolean, default=False)
     est_png = db.Column(db.Boolean, default=False)
     organisation_id = db.Column(db.Integer, db.ForeignKey("organisations.id"), nullable=True)
-    organisation = db.relationship("Organisation", foreign_keys=[organisation_id])
+    organisation = db.relationship("Organisation", foreign_keys=[organisation_id], lazy="selectin")
+    nom_normalise = db.Column(db.String(120), nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_brigand_nom_id", "nom", "id"),
+    )
+
+    @validates("nom")
+    def _maj_nom_normalise(self, key, nom):
+        self.nom_normalise = normaliser_nom(nom)
+        return nom
+
+class TableVersion(db.Model):
+    # Compteur incrémenté dans la transaction de chaque écriture (ETag des listes)
+    __tablename__ = "table_versions"
+    nom = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+def version_table(nom):
+    return db.session.query(TableVersion.version).filter_by(nom=nom).scalar() or 0
+
+def incrementer_version(*noms):
+    for nom in noms:
+        res = db.session.execute(
+            update(TableVersion).where(TableVersion.nom == nom).values(version=TableVersion.version + 1)
+        )
+        if not res.rowcount:
+            db.session.add(TableVersion(nom=nom, version=1))
 
 # ---------- Rendu Markdown sûr (sanitize) ----------
-ALLOWED_TAGS = bleach.sanitizer.ALLOWED_TAGS.union({
+# markdown et bleach ne sont importés qu'au premier rendu de guide (démarrage plus rapide)
+BALISES_EN_PLUS = {
     "p","br","hr","pre","code","blockquote","ul","ol","li","strong","em","b","i","u",
     "h1","h2","h3","h4","h5","h6","img","a","table","thead","tbody","tr","th","td"
-})
-ALLOWED_ATTRS = {
-    **bleach.sanitizer.ALLOWED_ATTRIBUTES,
+}
+ATTRIBUTS_EN_PLUS = {
     "a": ["href", "title", "target", "rel"],
     "img": ["src", "alt", "title", "width", "height"],
     "table": ["border", "cellpadding", "cellspacing"]
 }
 
+MARKDOWN_EXTENSIONS = ["extra", "tables", "sane_lists", "codehilite", "toc"]
+# Pas de devinette du langage par pygments (coûteuse) : ses balises sont de toute façon filtrées par bleach
+MARKDOWN_EXTENSION_CONFIGS = {"codehilite": {"guess_lang": False}}
+
+class RenduMarkdown(threading.local):
+    """Pipeline Markdown -> HTML assaini réutilisable : une instance Markdown
+    et un Cleaner bleach (avec LinkifyFilter) par thread, construits au
+    premier rendu. Ni l'un ni l'autre n'est thread-safe, d'où le threading.local."""
+
+    md = None
+
+    def _construire(self):
+        import markdown
+        import bleach
+        self.md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS,
+                                    extension_configs=MARKDOWN_EXTENSION_CONFIGS)
+        self.cleaner = bleach.sanitizer.Cleaner(
+            tags=bleach.sanitizer.ALLOWED_TAGS | BALISES_EN_PLUS,
+            attributes={**bleach.sanitizer.ALLOWED_ATTRIBUTES, **ATTRIBUTS_EN_PLUS},
+            filters=[partial(
+                bleach.linkifier.LinkifyFilter,
+                callbacks=[bleach.callbacks.nofollow, bleach.callbacks.target_blank],
+            )],
+        )
+
+    def rendre(self, text_md):
+        if self.md is None:
+            self._construire()
+        html = self.md.reset().convert(text_md or "")
+        return self.cleaner.clean(html)
+
+rendu_markdown = RenduMarkdown()
+
 def render_markdown_safe(text_md: str) -> str:
-    html = markdown.markdown(
-        text_md or "",
-        extensions=["extra", "tables", "sane_lists", "codehilite", "toc"]
-    )
-    clean = bleach.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRS)
-    clean = bleach.linkify(
-        clean,
-        callbacks=[bleach.callbacks.nofollow, bleach.callbacks.target_blank],
-    )
-    return clean
+    return rendu_markdown.rendre(text_md)
+
+@contextmanager
+def compter_requetes():
+    # Nombre d'instructions SQL émises dans le bloc : with compter_requetes() as n: ... n[0]
+    compteur = [0]
+    def _compter(*args):
+        compteur[0] += 1
+    event.listen(db.engine, "before_cursor_execute", _compter)
+    try:
+        yield compteur
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _compter)
+
+# ---------------------------------------------------------------------
+# Cache de lecture versionné (LRU + TTL par processus, backend partagé optionnel)
+# ---------------------------------------------------------------------
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))
+_MANQUE = object()
+
+class CacheLocal:
+    """LRU avec TTL en mémoire du processus. Expose la même interface que
+    CacheRedis : il sert de cache de premier niveau et de backend partagé de
+    substitution quand CACHE_URL n'est pas défini."""
+
+    def __init__(self, taille=512):
+        self.taille = taille
+        self._donnees = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, cle):
+        with self._lock:
+            entree = self._donnees.get(cle)
+            if entree is None:
+                return _MANQUE
+            if entree[0] < _time.monotonic():
+                del self._donnees[cle]
+                return _MANQUE
+            self._donnees.move_to_end(cle)
+            return entree[1]
+
+    def set(self, cle, valeur, ttl):
+        with self._lock:
+            self._donnees[cle] = (_time.monotonic() + ttl, valeur)
+            self._donnees.move_to_end(cle)
+            while len(self._donnees) > self.taille:
+                self._donnees.popitem(last=False)
+
+    def version(self, espace):
+        return self._versions.get(espace, 0)
+
+    def invalider(self, espace):
+        with self._lock:
+            self._versions[espace] = self._versions.get(espace, 0) + 1
+
+class CacheRedis:
+    # Backend partagé entre workers (CACHE_URL=redis://...). Valeurs sérialisées en JSON.
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2)
+
+    def get(self, cle):
+        brut = self.client.get("douanes:" + cle)
+        return _MANQUE if brut is None else json.loads(brut)
+
+    def set(self, cle, valeur, ttl):
+        self.client.set("douanes:" + cle, json.dumps(valeur), ex=ttl)
+
+    def version(self, espace):
+        return int(self.client.get("douanes:version:" + espace) or 0)
+
+    def invalider(self, espace):
+        self.client.incr("douanes:version:" + espace)
+
+class CacheLecture:
+    """Lecture à travers le cache : local, puis partagé, puis `charger()`.
+    La version de l'espace fait partie de la clé, donc invalider un espace
+    rend ses anciennes entrées inaccessibles partout, sans les parcourir."""
+
+    def __init__(self, partage=None, ttl=CACHE_TTL):
+        self.local = CacheLocal()
+        self.partage = partage
+        self.ttl = ttl
+
+    def _version(self, espace):
+        if self.partage is None:
+            return self.local.version(espace)
+        try:
+            return self.partage.version(espace)
+        except Exception:
+            return None  # backend indisponible : pas de cache
+
+    def lire(self, espace, cle, charger, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return charger()  # TTL nul : cache désactivé pour cette lecture
+        version = self._version(espace)
+        if version is None:
+            return charger()
+        k = f"{espace}:{version}:{cle}"
+        valeur = self.local.get(k)
+        if valeur is not _MANQUE:
+            return valeur
+        if self.partage is not None:
+            try:
+                valeur = self.partage.get(k)
+            except Exception:
+                valeur = _MANQUE
+            if valeur is not _MANQUE:
+                self.local.set(k, valeur, ttl)
+                return valeur
+        valeur = charger()
+        self.local.set(k, valeur, ttl)
+        if self.partage is not None:
+            try:
+                self.partage.set(k, valeur, ttl)
+            except Exception:
+                pass
+        return valeur
+
+    def invalider(self, espace):
+        self.local.invalider(espace)
+        if self.partage is not None:
+            try:
+                self.partage.invalider(espace)
+            except Exception as e:
+                # L'écriture est déjà validée : les autres workers se recalent à l'expiration du TTL
+                print(f"Invalidation du cache « {espace} » impossible :", e)
+
+cache = CacheLecture(CacheRedis(CACHE_URL) if CACHE_URL else None)
+
+# ---------------------------------------------------------------------
+# Requêtes allégées (projections de colonnes, sans entités ORM complètes)
+# ---------------------------------------------------------------------
+def noms_villages():
+    # Les villages ne changent que par manage.py add-villages (qui invalide l'espace)
+    return cache.lire("villages", "noms", lambda: [
+        nom for (nom,) in db.session.query(Village.nom).order_by(Village.nom.asc())
+    ])
+
+def villages_traites(jour):
+    # Couvert par l'index (report_date, village) : aucune colonne Text lue
+    lignes = db.session.query(Report.village).filter(Report.report_date == jour).distinct()
+    return [village for (village,) in lignes]
+
+def rapport_complet_or_404(rapport_id):
+    return Report.query.options(undefer_group("contenu")).filter_by(id=rapport_id).first_or_404()
+
+COLONNES_BRIGAND = {
+    "id": (Brigand.id,),
+    "nom": (Brigand.nom,),
+    "liste": (Brigand.liste,),
+    "faits": (Brigand.faits,),
+    "couronne": (Brigand.recherche_couronne,),
+    "png": (Brigand.est_png,),
+    "organisation_id": (Brigand.organisation_id,),
+    "organisation": (
+        Brigand.organisation_id,
+        Organisation.nom_complet.label("org_nom_complet"),
+        Organisation.nom_abrege.label("org_nom_abrege"),
+    ),
+}
+
+def requete_brigands(champs=None):
+    # id et nom sont toujours lus : ils servent de curseur de pagination
+    colonnes = {}
+    for champ in ("id", "nom", *(champs or COLONNES_BRIGAND)):
+        for col in COLONNES_BRIGAND[champ]:
+            colonnes.setdefault(col.key, col)
+    q = db.session.query(*colonnes.values())
+    if champs is None or "organisation" in champs:
+        q = q.outerjoin(Organisation, Brigand.organisation_id == Organisation.id)
+    return q
+
+def empreinte(texte):
+    return hashlib.sha1((texte or "").encode("utf-8")).hexdigest()
+
+def guide_html(g: Guide):
+    # Rendu une seule fois par version du contenu ; les lectures servent le HTML stocké
+    h = empreinte(g.content)
+    if g.content_hash != h:
+        g.content_html = render_markdown_safe(g.content)
+        g.content_hash = h
+        # updated_at=updated_at : un simple rattrapage du cache ne compte pas comme une modification
+        db.session.execute(
+            update(Guide).where(Guide.id == g.id)
+            .values(content_html=g.content_html, content_hash=h, updated_at=Guide.updated_at)
+        )
+        db.session.commit()
+    return g.content_html
 
 # ---------------------------------------------------------------------
 # Login / helpers
 # ---------------------------------------------------------------------
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+
+class UtilisateurSession(UserMixin):
+    """Utilisateur reconstruit depuis l'instantané de session (cookie signé
+    par SECRET_KEY) : les attributs lus par les vues, sans entité ORM."""
+
+    def __init__(self, id, username, role, bureau, version):
+        self.id, self.username, self.role, self.bureau, self.version = id, username, role, bureau, version
+
+def memoriser_utilisateur(user):
+    session["utilisateur"] = [user.id, user.username, user.role, user.bureau, user.version]
+
+def version_utilisateur(user_id):
+    # None si le compte n'existe plus. Cache court : un worker voit une suppression
+    # faite ailleurs au plus USER_CACHE_TTL s plus tard (immédiatement avec CACHE_URL).
+    return cache.lire(
+        "utilisateurs", str(user_id),
+        lambda: db.session.query(User.version).filter_by(id=user_id).scalar(),
+        ttl=USER_CACHE_TTL
+    )
+
+def invalider_utilisateurs():
+    # Après commit d'une modification ou suppression de comptes
+    cache.invalider("utilisateurs")
+
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return db.session.get(User, int(user_id))
-    except Exception as e:
-        print("Erreur lors du chargement de l'utilisateur :", e)
+        user_id = int(user_id)
+    except (TypeError, ValueError):
         return None
+    version = version_utilisateur(user_id)
+    if version is None:
+        return None
+    instantane = session.get("utilisateur")
+    if instantane and instantane[0] == user_id and instantane[4] == version:
+        return UtilisateurSession(*instantane)
+    user = db.session.get(User, user_id)
+    if user is not None:
+        memoriser_utilisateur(user)
+    return user
 
 # ---------------------------------------------------------------------
-# Initialisation et migrations légères
+# Schéma : migrations numérotées, appliquées par « python manage.py migrate »
 # ---------------------------------------------------------------------
-def ensure_user_bureau_column():
-    from sqlalchemy import inspect
-    insp = inspect(db.engine)
-    if "user" in insp.get_table_names():
-        cols = [c["name"] for c in insp.get_columns("user")]
-        if "bureau" not in cols:
-            with db.engine.connect() as conn:
-                conn.execute(text('ALTER TABLE "user" ADD COLUMN bureau VARCHAR(120)'))
-                conn.execute(text("UPDATE \"user\" SET bureau = 'Armagnac & Comminges' WHERE bureau IS NULL"))
-                conn.execute(text("ALTER TABLE \"user\" ALTER COLUMN bureau SET DEFAULT 'Armagnac & Comminges'"))
-                conn.commit()
-
-def ensure_brigand_organisation_id_column_and_migrate():
-    from sqlalchemy import inspect
-    insp = inspect(db.engine)
-    if "brigand" in insp.get_table_names():
-        cols = [c["name"] for c in insp.get_columns("brigand")]
-        if "organisation_id" not in cols:
-            with db.engine.connect() as conn:
-                conn.execute(text('ALTER TABLE "brigand" ADD COLUMN organisation_id INTEGER NULL REFERENCES organisations(id)'))
-                conn.commit()
-        with app.app_context():
-            brigands = Brigand.query.all()
-            for b in brigands:
-                if b.organisation_id is None and (b.order or "").strip():
-                    legacy = (b.order or "").strip()
-                    org = Organisation.query.filter(
-                        (Organisation.nom_abrege == legacy) | (Organisation.nom_complet == legacy)
-                    ).first()
-                    if org:
-                        b.organisation_id = org.id
-            db.session.commit()
+class SchemaVersion(db.Model):
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    appliquee_le = db.Column(db.DateTime, default=datetime.utcnow)
 
-def ensure_guides_exist():
-    changed = False
-    if not Guide.query.filter_by(audience="marechal").first():
-        g = Guide(audience="marechal", content="*(Vide)*\n\nRédigez ici le **Guide maréchal**.")
-        db.session.add(g); changed = True
-    if not Guide.query.filter_by(audience="prevot").first():
-        g = Guide(audience="prevot", content="*(Vide)*\n\nRédigez ici le **Guide prévôt**.")
-        db.session.add(g); changed = True
-    if changed:
-        db.session.commit()
+def colonnes(conn, table):
+    from sqlalchemy import inspect
+    insp = inspect(conn)
+    if table not in insp.get_table_names():
+        return None
+    return {c["name"] for c in insp.get_columns(table)}
+
+def migration_user_bureau(conn):
+    cols = colonnes(conn, "user")
+    if cols is not None and "bureau" not in cols:
+        conn.execute(text('ALTER TABLE "user" ADD COLUMN bureau VARCHAR(120)'))
+        conn.execute(text("UPDATE \"user\" SET bureau = 'Armagnac & Comminges' WHERE bureau IS NULL"))
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE \"user\" ALTER COLUMN bureau SET DEFAULT 'Armagnac & Comminges'"))
+
+def migration_brigand_organisation_id(conn):
+    cols = colonnes(conn, "brigand")
+    if cols is None:
+        return
+    if "organisation_id" not in cols:
+        conn.execute(text('ALTER TABLE "brigand" ADD COLUMN organisation_id INTEGER NULL REFERENCES organisations(id)'))
+    # Reprise de l'ancien champ texte « order », seulement s'il existe encore dans la table
+    if "order" in cols:
+        conn.execute(text(
+            'UPDATE "brigand" SET organisation_id = ('
+            '  SELECT o.id FROM organisations o'
+            '  WHERE o.nom_abrege = TRIM("brigand"."order") OR o.nom_complet = TRIM("brigand"."order")'
+            '  ORDER BY o.id LIMIT 1'
+            ') WHERE organisation_id IS NULL AND TRIM(COALESCE("order", \'\')) <> \'\''
+        ))
+
+def migration_brigand_nom_normalise(conn):
+    cols = colonnes(conn, "brigand")
+    if cols is None:
+        return
+    if "nom_normalise" not in cols:
+        conn.execute(text('ALTER TABLE "brigand" ADD COLUMN nom_normalise VARCHAR(120) NULL'))
+    a_remplir = conn.execute(text('SELECT id, nom FROM "brigand" WHERE nom_normalise IS NULL')).all()
+    if a_remplir:
+        conn.execute(text('UPDATE "brigand" SET nom_normalise = :n WHERE id = :id'),
+                     [{"id": id_, "n": normaliser_nom(nom)} for id_, nom in a_remplir])
+
+def migration_index(conn):
+    # create_all ne crée les index que pour les tables nouvelles
+    for model in (Report, Brigand):
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+def migration_trigrammes(conn):
+    # PostgreSQL : index GIN pg_trgm ; ailleurs (ou sans l'extension), index n-grammes en mémoire.
+    # Renvoie la raison pour laquelle la migration est sans effet, le cas échéant.
+    if conn.dialect.name != "postgresql":
+        return f"sans objet sur {conn.dialect.name}"
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_brigand_nom_trgm ON "brigand" USING gin (nom_normalise gin_trgm_ops)'
+            ))
+    except Exception as e:
+        print("pg_trgm indisponible, recherche floue en mémoire :", e)
+        return "extension pg_trgm indisponible"
+
+def migration_guide_html(conn):
+    cols = colonnes(conn, "guide")
+    if cols is None:
+        return
+    if "content_html" not in cols:
+        conn.execute(text('ALTER TABLE "guide" ADD COLUMN content_html TEXT NULL'))
+    if "content_hash" not in cols:
+        conn.execute(text('ALTER TABLE "guide" ADD COLUMN content_hash VARCHAR(40) NULL'))
+
+def migration_report_rendu_statut(conn):
+    cols = colonnes(conn, "report")
+    if cols is not None and "rendu_statut" not in cols:
+        conn.execute(text("ALTER TABLE report ADD COLUMN rendu_statut VARCHAR(20) NOT NULL DEFAULT 'pret'"))
+
+def migration_user_version(conn):
+    cols = colonnes(conn, "user")
+    if cols is not None and "version" not in cols:
+        conn.execute(text('ALTER TABLE "user" ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+
+def migration_report_rendu_debut(conn):
+    cols = colonnes(conn, "report")
+    if cols is not None and "rendu_debut" not in cols:
+        conn.execute(text("ALTER TABLE report ADD COLUMN rendu_debut TIMESTAMP"))
+
+def migration_guides_par_defaut(conn):
+    existants = {a for (a,) in conn.execute(db.select(Guide.audience))}
+    for audience, titre in (("marechal", "Guide maréchal"), ("prevot", "Guide prévôt")):
+        if audience not in existants:
+            conn.execute(insert(Guide).values(
+                audience=audience, content=f"*(Vide)*\n\nRédigez ici le **{titre}**."
+            ))
+
+# (numéro, description, fonction(conn)) ; la fonction peut renvoyer la raison pour laquelle elle est sans effet
+MIGRATIONS = [
+    (1, "Colonne user.bureau", migration_user_bureau),
+    (2, "Colonne brigand.organisation_id", migration_brigand_organisation_id),
+    (3, "Colonne brigand.nom_normalise", migration_brigand_nom_normalise),
+    (4, "Index report / brigand", migration_index),
+    (5, "Index pg_trgm sur brigand.nom_normalise", migration_trigrammes),
+    (6, "Colonnes guide.content_html / content_hash", migration_guide_html),
+    (7, "Colonne report.rendu_statut", migration_report_rendu_statut),
+    (8, "Colonne user.version", migration_user_version),
+    (9, "Guides par défaut", migration_guides_par_defaut),
+    (10, "Colonne report.rendu_debut", migration_report_rendu_debut),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# SQLite (développement, un seul processus) : migration au démarrage par défaut
+MIGRATION_AU_DEMARRAGE = os.getenv(
+    "MIGRATION_AU_DEMARRAGE", "1" if db_url.startswith("sqlite") else "0"
+) == "1"
+
+def version_schema():
+    # Une seule requête ; 0 si la table schema_version n'existe pas encore
+    try:
+        return db.session.query(func.max(SchemaVersion.version)).scalar() or 0
+    except Exception:
+        db.session.rollback()
+        return 0
+    finally:
+        db.session.close()
 
-with app.app_context():
+def migrer(afficher=print):
+    """Crée les tables nouvelles puis applique, chacune dans sa transaction,
+    les migrations pas encore enregistrées dans schema_version."""
     db.create_all()
-    ensure_user_bureau_column()
-    ensure_brigand_organisation_id_column_and_migrate()
-    ensure_guides_exist()
+    courante = version_schema()
+    for numero, description, migration in MIGRATIONS:
+        if numero <= courante:
+            continue
+        with db.engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # Deux déploiements simultanés : le second attend puis constate la migration faite
+                conn.execute(text("SELECT pg_advisory_xact_lock(72230001)"))
+            deja = conn.execute(
+                db.select(SchemaVersion.version).where(SchemaVersion.version == numero)
+            ).first()
+            if deja:
+                continue
+            sautee = migration(conn)
+            conn.execute(insert(SchemaVersion).values(
+                version=numero, description=description, appliquee_le=datetime.utcnow()
+            ))
+        if sautee:
+            afficher(f"Migration {numero} ignorée ({sautee}) : {description}")
+        else:
+            afficher(f"Migration {numero} appliquée : {description}")
+    return version_schema()
+
+@lru_cache(maxsize=1)
+def trgm_disponible():
+    # Index pg_trgm posé par la migration 5 (absent hors PostgreSQL ou sans l'extension)
+    if db.engine.dialect.name != "postgresql":
+        return False
+    with db.engine.connect() as conn:
+        return conn.execute(text(
+            "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_brigand_nom_trgm'"
+        )).first() is not None
+
+def verifier_schema():
+    # Démarrage : une seule requête, la migration elle-même relève de manage.py migrate
+    version = version_schema()
+    if version < SCHEMA_VERSION:
+        if MIGRATION_AU_DEMARRAGE:
+            migrer()
+        else:
+            print(f"Schéma en version {version}, attendu {SCHEMA_VERSION} : lancez « python manage.py migrate ».")
 
 # ---------------------------------------------------------------------
 # Génération BBCode du rapport maréchal
 # ---------------------------------------------------------------------
 def detecter_noms(visions, villageois, groupes_armées):
-    import re
-    def extraire_depuis_texte(texte):
-        texte = re.sub(r'\[.*?\]', '', texte)
-        tokens = re.split(r'[,\n;:\-\(\)\[\]]+', texte)
-        noms = []
-        for token in tokens:
-            mot = token.strip()
-            if len(mot) >= 3 and any(c.isupper() for c in mot):
-                noms.append(mot)
-        return noms
-    noms_visions = extraire_depuis_texte(visions)
-    noms_villageois = extraire_depuis_texte(villageois)
-    noms_groupes = extraire_depuis_texte(groupes_armées)
-    tous_noms = noms_visions + noms_villageois + noms_groupes
-    noms_uniques = list(set(tous_noms))
-    return noms_uniques
+    # Noms connus (brigands / organisations), dans l'ordre de première apparition
+    vus = {}
+    for texte in (visions, villageois, groupes_armées):
+        for _, _, entree in index_noms.occurrences(texte or ""):
+            vus.setdefault(entree["nom"], None)
+    return list(vus)
+
+# ---------------------------------------------------------------------
+# Index des noms connus (brigands / organisations)
+# ---------------------------------------------------------------------
+NAME_INDEX_TTL = int(os.getenv("NAME_INDEX_TTL", "300"))
+
+COULEURS_TYPOLOGIE = {
+    'couronne': 'darkorange',
+    'liste noire': 'red',
+    'surveillance': 'darkred',
+    'png': 'indigo'
+}
+
+def typologie_brigand(liste, couronne=False, png=False):
+    if couronne:
+        return "couronne"
+    if png:
+        return "png"
+    if (liste or "") in ("noire", "hors"):
+        return "liste noire"
+    if (liste or "") == "surveillance":
+        return "surveillance"
+    return ""
+
+TITRES_PACK = ['de', 'du', 'd’', 'le', 'la', 'des', 'l’', 'de la', 'de l’']
+
+# Titre nobiliaire accolé à un nom : " de la Tour", " d’Armagnac", " d'Auch"...
+RE_TITRE = re.compile(
+    r" (?:" + "|".join(
+        re.escape(t).replace("’", "['’]") + ("" if t.endswith("’") else " ")
+        for t in sorted(TITRES_PACK, key=len, reverse=True)
+    ) + r")(?=[^\W\d_])[\w\-’']+",
+    re.IGNORECASE
+)
+
+def plier(texte):
+    # Minuscules caractère par caractère (la longueur est conservée, les
+    # positions restent valables dans le texte d'origine) et apostrophes unifiées.
+    plie = []
+    for c in texte:
+        bas = c.lower()
+        plie.append(bas if len(bas) == 1 else c)
+    return "".join(plie).replace("'", "’")
+
+def est_car_mot(c):
+    return c.isalnum() or c == "_"
+
+class AutomateNoms:
+    """Automate d'Aho-Corasick sur les noms pliés. Les ajouts/retraits
+    modifient le trie en place ; les liens d'échec sont recalculés à la
+    demande, au prochain parcours."""
+
+    def __init__(self):
+        self._transitions = [{}]
+        self._sortie = [None]
+        self._profondeur = [0]
+        self._echec = [0]
+        self._suffixe_sortie = [0]
+        self._compile = True
+        self.taille = 0
+
+    def _noeud(self, motif, creer=False):
+        noeud = 0
+        for c in plier(motif):
+            suivant = self._transitions[noeud].get(c)
+            if suivant is None:
+                if not creer:
+                    return None
+                suivant = len(self._transitions)
+                self._transitions.append({})
+                self._sortie.append(None)
+                self._profondeur.append(self._profondeur[noeud] + 1)
+                self._echec.append(0)
+                self._suffixe_sortie.append(0)
+                self._transitions[noeud][c] = suivant
+            noeud = suivant
+        return noeud
+
+    def ajouter(self, motif, valeur):
+        if not motif:
+            return
+        noeud = self._noeud(motif, creer=True)
+        if self._sortie[noeud] is None:
+            self.taille += 1
+        self._sortie[noeud] = valeur
+        self._compile = False
+
+    def retirer(self, motif):
+        noeud = self._noeud(motif or "")
+        if noeud and self._sortie[noeud] is not None:
+            self._sortie[noeud] = None
+            self.taille -= 1
+            self._compile = False
+
+    def _compiler(self):
+        file = deque()
+        for noeud in self._transitions[0].values():
+            self._echec[noeud] = 0
+            self._suffixe_sortie[noeud] = 0
+            file.append(noeud)
+        while file:
+            parent = file.popleft()
+            for c, noeud in self._transitions[parent].items():
+                repli = self._echec[parent]
+                while repli and c not in self._transitions[repli]:
+                    repli = self._echec[repli]
+                repli = self._transitions[repli].get(c, 0)
+                self._echec[noeud] = repli if repli != noeud else 0
+                self._suffixe_sortie[noeud] = (
+                    repli if self._sortie[repli] is not None else self._suffixe_sortie[repli]
+                )
+                file.append(noeud)
+        self._compile = True
+
+    def rechercher(self, texte):
+        """Occurrences (debut, fin, valeur) délimitées par des frontières de
+        mot, la plus longue à gauche d'abord, sans chevauchement."""
+        if not texte or not self.taille:
+            return []
+        if not self._compile:
+            self._compiler()
+        transitions, echec, sortie = self._transitions, self._echec, self._sortie
+        suffixe, profondeur = self._suffixe_sortie, self._profondeur
+        n = len(texte)
+        meilleures = {}
+        noeud = 0
+        for i, c in enumerate(plier(texte)):
+            while noeud and c not in transitions[noeud]:
+                noeud = echec[noeud]
+            noeud = transitions[noeud].get(c, 0)
+            fin = i + 1
+            if fin < n and est_car_mot(texte[fin]):
+                continue
+            trouve = noeud if sortie[noeud] is not None else suffixe[noeud]
+            while trouve:
+                debut = fin - profondeur[trouve]
+                if (debut == 0 or not est_car_mot(texte[debut - 1])) and fin > meilleures.get(debut, (0,))[0]:
+                    meilleures[debut] = (fin, sortie[trouve])
+                trouve = suffixe[trouve]
+        occurrences = []
+        derniere_fin = 0
+        for debut in sorted(meilleures):
+            if debut >= derniere_fin:
+                fin, valeur = meilleures[debut]
+                occurrences.append((debut, fin, valeur))
+                derniere_fin = fin
+        return occurrences
+
+class IndexNoms:
+    """Index en mémoire des noms connus, construit une fois puis tenu à jour
+    par les API brigands/organisations (rechargé après NAME_INDEX_TTL
+    secondes, pour les écritures faites par les autres workers)."""
+
+    def __init__(self, ttl=NAME_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entrees = None
+        self._automate = None
+        # Plusieurs brigands ou organisations peuvent partager un nom plié : chaque clé garde
+        # ses propriétaires, et ne quitte l'automate qu'avec le dernier
+        self._proprietaires = None
+        self._cle_brigand = None
+        self._construit_le = 0.0
+
+    def invalider(self):
+        with self._lock:
+            self._entrees = None
+            self._automate = None
+
+    def _charger(self):
+        self._entrees, self._automate = {}, AutomateNoms()
+        self._proprietaires, self._cle_brigand = {}, {}
+        for id_, nom_abrege, nom_complet in db.session.query(
+                Organisation.id, Organisation.nom_abrege, Organisation.nom_complet):
+            label = (nom_abrege or "").strip() or (nom_complet or "").strip()
+            for nom in (nom_abrege, nom_complet):
+                if (nom or "").strip():
+                    self._poser(plier(nom.strip()), ("organisation", id_), {
+                        "nom": nom.strip(), "type": "organisation",
+                        "typologie": "", "organisation": label
+                    })
+        lignes = (
+            db.session.query(Brigand.id, Brigand.nom, Brigand.liste, Brigand.recherche_couronne, Brigand.est_png,
+                             Organisation.nom_abrege, Organisation.nom_complet)
+            .outerjoin(Organisation, Brigand.organisation_id == Organisation.id)
+        )
+        for id_, nom, liste, couronne, png, org_abrege, org_complet in lignes:
+            if (nom or "").strip():
+                self._poser(plier(nom.strip()), ("brigand", id_), self._entree_brigand(
+                    nom, liste, couronne, png, (org_abrege or "").strip() or (org_complet or "").strip()
+                ))
+
+    def _poser(self, cle, proprio, entree):
+        proprios = self._proprietaires.setdefault(cle, {})
+        proprios.pop(proprio, None)
+        proprios[proprio] = entree
+        if proprio[0] == "brigand":
+            self._cle_brigand[proprio[1]] = cle
+        self._publier(cle)
+
+    def _retirer(self, cle, proprio):
+        proprios = self._proprietaires.get(cle)
+        if not proprios or proprios.pop(proprio, None) is None:
+            return
+        if proprio[0] == "brigand":
+            self._cle_brigand.pop(proprio[1], None)
+        if proprios:
+            self._publier(cle)
+        else:
+            del self._proprietaires[cle]
+            self._entrees.pop(cle, None)
+            self._automate.retirer(cle)
+
+    def _publier(self, cle):
+        # Un brigand l'emporte sur une organisation homonyme ; à type égal, le dernier posé
+        proprios = list(self._proprietaires[cle].items())
+        brigands = [e for (type_, _), e in proprios if type_ == "brigand"]
+        entree = brigands[-1] if brigands else proprios[-1][1]
+        self._entrees[cle] = entree
+        self._automate.ajouter(cle, entree)
+
+    @staticmethod
+    def _entree_brigand(nom, liste, couronne, png, organisation):
+        return {
+            "nom": nom.strip(), "type": "brigand",
+            "typologie": typologie_brigand(liste, couronne, png),
+            "organisation": organisation
+        }
+
+    def _courant(self):
+        if self._entrees is None or _time.monotonic() - self._construit_le > self.ttl:
+            self._charger()
+            self._construit_le = _time.monotonic()
+        return self._entrees, self._automate
+
+    def maj_brigand(self, brigand):
+        # Création, modification ou renommage : le brigand quitte son ancienne clé s'il en avait une
+        with self._lock:
+            if self._entrees is None:
+                return
+            ancienne = self._cle_brigand.get(brigand.id)
+            if ancienne is not None:
+                self._retirer(ancienne, ("brigand", brigand.id))
+            if (brigand.nom or "").strip():
+                self._poser(plier(brigand.nom.strip()), ("brigand", brigand.id), self._entree_brigand(
+                    brigand.nom, brigand.liste, brigand.recherche_couronne, brigand.est_png,
+                    org_display_label(brigand.organisation)
+                ))
+
+    def oublier(self, nom):
+        # Brigands supprimés par nom : les homonymes pliés (autre graphie, organisation) restent
+        with self._lock:
+            if self._entrees is None:
+                return
+            nom = (nom or "").strip()
+            cle = plier(nom)
+            for proprio, entree in list(self._proprietaires.get(cle, {}).items()):
+                if proprio[0] == "brigand" and entree["nom"] == nom:
+                    self._retirer(cle, proprio)
+
+    def chercher(self, nom):
+        with self._lock:
+            entrees, _ = self._courant()
+            nom = (nom or "").strip()
+            entree = entrees.get(plier(nom))
+            if entree is None:
+                nom_split = nom.split()
+                if len(nom_split) > 1 and nom_split[1].lower() in TITRES_PACK:
+                    entree = entrees.get(plier(nom_split[0]))
+            return entree
+
+    def occurrences(self, texte):
+        """Noms connus présents dans le texte : (debut, fin, entree), titre
+        nobiliaire éventuel inclus dans l'empan."""
+        with self._lock:
+            _, automate = self._courant()
+            trouves = automate.rechercher(texte or "")
+        resultat = []
+        for debut, fin, entree in trouves:
+            titre = RE_TITRE.match(texte, fin)
+            if titre:
+                fin = titre.end()
+            resultat.append((debut, fin, entree))
+        return resultat
+
+    def enrichir(self, texte, occurrences=None):
+        # occurrences : résultat de occurrences(texte) déjà calculé (reperer_noms)
+        if not texte:
+            return texte
+        if occurrences is None:
+            occurrences = self.occurrences(texte)
+        morceaux = []
+        curseur = 0
+        for i, (debut, fin, entree) in enumerate(occurrences):
+            if debut < curseur:
+                continue
+            morceaux.append(texte[curseur:debut])
+            morceaux.append(annoter_nom(texte[debut:fin], entree,
+                                        avec_organisation=not organisation_voisine(texte, occurrences, i)))
+            curseur = fin
+        morceaux.append(texte[curseur:])
+        return "".join(morceaux)
+
+index_noms = IndexNoms()
+
+RE_ENTRE_NOM_ORGANISATION = re.compile(r"[ \t()\[\]:,|—–-]*")
+
+def organisation_voisine(texte, occurrences, i):
+    # L'organisation du brigand est déjà écrite contre son nom (« Bidule (LLG) ») : pas de doublon
+    debut, fin, entree = occurrences[i]
+    if entree["type"] != "brigand" or not entree["organisation"]:
+        return False
+    for j in (i - 1, i + 1):
+        if 0 <= j < len(occurrences):
+            d, f, e = occurrences[j]
+            if e["type"] == "organisation" and e["organisation"] == entree["organisation"]:
+                entre = texte[fin:d] if j > i else texte[f:debut]
+                if RE_ENTRE_NOM_ORGANISATION.fullmatch(entre):
+                    return True
+    return False
+
+def annoter_nom(texte, entree, avec_organisation=True):
+    if entree["type"] == "organisation":
+        return f"[b]{texte}[/b]"
+    couleur = COULEURS_TYPOLOGIE.get(entree["typologie"], '')
+    bloc = f"[color={couleur}]{texte}[/color]" if couleur else texte
+    if avec_organisation and entree["organisation"]:
+        bloc += f" ({entree['organisation']})"
+    return bloc
 
 def enrichir_nom(nom_ig):
-    # TODO: intégration prévôtale (liens brigands/orga/fiches)
-    return nom_ig
+    return index_noms.enrichir(nom_ig)
 
 def generer_memoire_visions(nom_ig, typologie='', est_ac=False):
-    titres_pack = ['de', 'du', 'd’', 'le', 'la', 'des', 'l’', 'de la', 'de l’']
     nom_split = nom_ig.strip().split()
-    nom_reel = nom_split[0] if len(nom_split) > 1 and nom_split[1].lower() in titres_pack else nom_ig
+    nom_reel = nom_split[0] if len(nom_split) > 1 and nom_split[1].lower() in TITRES_PACK else nom_ig
     couleur = {
         'couronne': 'darkorange',
         'liste noire': 'red',
@@ -290,9 +1283,8 @@ def generer_surveillance_bbcode(nom_ig, typologie='', organisation='', faits='',
         mention = ' — Recherché par la Couronne de France'
     elif typologie.lower() == 'png':
         mention = ' — PNG Interdit de territoire'
-    titres_pack = ['de', 'du', 'd’', 'le', 'la', 'des', 'l’', 'de la', 'de l’']
     nom_split = nom_ig.strip().split()
-    nom_reel = nom_split[0] if len(nom_split) > 1 and nom_split[1].lower() in titres_pack else nom_ig
+    nom_reel = nom_split[0] if len(nom_split) > 1 and nom_split[1].lower() in TITRES_PACK else nom_ig
     nom_formaté = f"[b]{nom_reel}[/b]" if est_ac else nom_ig
     if est_ac and len(nom_split) > 1:
         nom_formaté += ' ' + ' '.join(nom_split[1:])
@@ -306,77 +1298,85 @@ def generer_surveillance_bbcode(nom_ig, typologie='', organisation='', faits='',
         ligne += f" ({statut})"
     return ligne
 
-def bbcode_report(village_name, d, mem_visions, surveillance, flux, etrangers, ac_presence, armies_groups, villagers, moves):
-    date_str = d.strftime("%d %B %Y") if d else "Date inconnue"
-    lines = []
-
-    def title(label, count=None):
-        suffix = f" [color=blue][b]{count}[/b][/color]" if count is not None else ""
-        lines.append(f"[color={REPORT_TITLE_COLOR}][size=14][b][u]{label}[/u] :[/b][/size][/color]{suffix}\n")
-
-    lines.append(f"[quote][center][b][size=18]{village_name}[/size]\nRapport de la maréchaussée du {date_str}.[/b][/center]\n")
+RAS = "[b]RAS.[/b]"
+
+def lignes_non_vides(brut):
+    return [ligne.strip() for ligne in (brut or "").strip().split('\n') if ligne.strip()]
+
+def analyser_memoire_visions(mem_visions):
+    # Lignes « nom | typologie | a&c », typologie complétée par l'index des noms
+    entrees = []
+    for ligne in (mem_visions or "").strip().split('\n'):
+        parts = [p.strip() for p in ligne.split('|')]
+        if not parts or not parts[0]:
+            continue
+        nom_ig = parts[0]
+        typologie = parts[1] if len(parts) > 1 else ''
+        est_ac = 'a&c' in parts[2].lower() if len(parts) > 2 else False
+        if not typologie:
+            typologie = (index_noms.chercher(nom_ig) or {}).get("typologie", '')
+        entrees.append(dict(nom_ig=nom_ig, typologie=typologie, est_ac=est_ac))
+    return entrees
+
+def analyser_rapport(mem_visions, surveillance):
+    """Un seul passage sur les sections à champs « | » : il alimente le rendu
+    BBCode, la table report_entry et la synthèse de douane."""
+    return {
+        "mem_visions": analyser_memoire_visions(mem_visions),
+        "surveillance": analyser_surveillance(surveillance),
+    }
 
-    if mem_visions.strip():
-        lignes_mv = mem_visions.strip().split('\n')
-        bloc_mv = []
-        for ligne in lignes_mv:
-            parts = [p.strip() for p in ligne.split('|')]
-            if not parts or not parts[0]:
-                continue
-            nom_ig = parts[0]
-            typologie = parts[1] if len(parts) > 1 else ''
-            est_ac = 'a&c' in parts[2].lower() if len(parts) > 2 else False
-            bbcode = generer_memoire_visions(nom_ig, typologie, est_ac)
-            bloc_mv.append(bbcode)
-        mv = '\n'.join(bloc_mv) if bloc_mv else "[b]RAS.[/b]"
-    else:
-        mv = "[b]RAS.[/b]"
-    title("MÉMOIRE ET VISIONS")
-    lines.append(mv + "\n\n")
-
-    if surveillance.strip():
-        lignes_surv = surveillance.strip().split('\n')
-        bloc_surv = []
-        for ligne in lignes_surv:
-            parts = [p.strip() for p in ligne.split('|')]
-            if not parts or not parts[0]:
-                continue
-            nom_ig = parts[0]
-            typologie = parts[1] if len(parts) > 1 else ''
-            organisation = parts[2] if len(parts) > 2 else ''
-            faits = parts[3] if len(parts) > 3 else ''
-            statut = parts[4] if len(parts) > 4 else ''
-            est_ac = 'a&c' in parts[5].lower() if len(parts) > 5 else False
-            bbcode = generer_surveillance_bbcode(nom_ig, typologie, organisation, faits, statut, est_ac)
-            bloc_surv.append(bbcode)
-        surveillance_bbcode = '\n'.join(bloc_surv) if bloc_surv else "[b]RAS.[/b]"
-    else:
-        surveillance_bbcode = "[b]RAS.[/b]"
-    title("PERSONNES EN SURVEILLANCE", count_lines(surveillance_bbcode))
-    lines.append(surveillance_bbcode + "\n\n")
-
-    def enrichir_bloc(brut):
-        lignes = (brut or "").strip().split('\n')
-        bloc = []
-        for ligne in lignes:
-            if ligne.strip():
-                bloc.append(enrichir_nom(ligne.strip()))
-        return '\n'.join(bloc) if bloc else "[b]RAS.[/b]"
-
-    title("FLUX MIGRATOIRES", count_lines(flux))
-    lines.append(enrichir_bloc(flux) + "\n\n")
-    title("PRÉSENCES ÉTRANGÈRES", count_lines(etrangers))
-    lines.append(enrichir_bloc(etrangers) + "\n\n")
-    title("PRÉSENCES ARMAGNACAISES & COMMINGEOISES", count_lines(ac_presence))
-    lines.append(enrichir_bloc(ac_presence) + "\n\n")
-    title("ARMÉES ET GROUPES", count_lines(armies_groups))
-    lines.append(enrichir_bloc(armies_groups) + "\n\n")
-    title("LISTE DES VILLAGEOIS & DÉMÉNAGEMENTS")
-    bloc_moves = enrichir_bloc(moves)
-    bloc_villagers = enrichir_bloc(villagers)
-    lines.append(f"[spoiler][quote]Déménagements[/quote]\n{bloc_moves}\n{bloc_villagers}\n[/spoiler]\n\n")
-
-    legend = (
+def bloc_memoire_visions(mem_visions, entrees=None):
+    if entrees is None:
+        entrees = analyser_memoire_visions(mem_visions)
+    return [generer_memoire_visions(**e) for e in entrees]
+
+def analyser_surveillance(surveillance):
+    # Lignes « nom | typologie | organisation | faits | statut | a&c », complétées par l'index des noms
+    entrees = []
+    for ligne in (surveillance or "").strip().split('\n'):
+        parts = [p.strip() for p in ligne.split('|')]
+        if not parts or not parts[0]:
+            continue
+        nom_ig = parts[0]
+        typologie = parts[1] if len(parts) > 1 else ''
+        organisation = parts[2] if len(parts) > 2 else ''
+        faits = parts[3] if len(parts) > 3 else ''
+        statut = parts[4] if len(parts) > 4 else ''
+        est_ac = 'a&c' in parts[5].lower() if len(parts) > 5 else False
+        connu = index_noms.chercher(nom_ig) or {}
+        entrees.append(dict(
+            nom_ig=nom_ig,
+            typologie=typologie or connu.get("typologie", ''),
+            organisation=organisation or connu.get("organisation", ''),
+            faits=faits, statut=statut, est_ac=est_ac
+        ))
+    return entrees
+
+def bloc_surveillance(surveillance, entrees=None):
+    if entrees is None:
+        entrees = analyser_surveillance(surveillance)
+    return [generer_surveillance_bbcode(**e) for e in entrees]
+
+def bloc_section(brut):
+    return '\n'.join(lignes_non_vides(brut))
+
+def enrichir_bloc(brut, occurrences=None):
+    bloc = bloc_section(brut)
+    return index_noms.enrichir(bloc, occurrences) if bloc else RAS
+
+def reperer_noms(r, sections=None):
+    """Un seul passage de l'automate par section, au dépôt : {section: occurrences}
+    sur le bloc tel que rendu, partagé par le BBCode, l'agrégat, les observations
+    et la synthèse."""
+    return {cle: index_noms.occurrences(bloc_section(getattr(r, cle)))
+            for cle in sections or SECTIONS_AGREGAT}
+
+class GabaritRapport:
+    """Mise en page BBCode du rapport maréchal, compilée une fois : titres de
+    section, en-tête et légende sont figés ; seul le contenu varie."""
+
+    LEGENDE = (
         "[quote][size=9][b]LÉGENDE[/b] :\n"
         "[color=darkorange][b]Orange[/b][/color] : Recherché par la Couronne de France.\n"
         "[color=red][b]Rouge[/b][/color] : Surveillance accrue (liste noire, casier judiciaire, etc.).\n"
@@ -385,13 +1385,85 @@ def bbcode_report(village_name, d, mem_visions, surveillance, flux, etrangers, a
         "[color=green][b]Vert[/b][/color] : Individu sans antécédent judiciaire chez A&C.\n"
         "(statuts spéciaux) : (en prison), (en retraite spirituelle), (en retranchement), (mort).[/size][/quote]"
     )
-    lines.append(legend + "\n[/quote]")
-    return "\n".join(lines)
+
+    def __init__(self, couleur_titre=REPORT_TITLE_COLOR):
+        titre = f"[color={couleur_titre}][size=14][b][u]{{}}[/u] :[/b][/size][/color]"
+        compteur = " [color=blue][b]{}[/b][/color]"
+        self._titres = {}
+        for cle, label in (
+            ("mem_visions", "MÉMOIRE ET VISIONS"),
+            ("surveillance", "PERSONNES EN SURVEILLANCE"),
+            ("flux", "FLUX MIGRATOIRES"),
+            ("etrangers", "PRÉSENCES ÉTRANGÈRES"),
+            ("ac_presence", "PRÉSENCES ARMAGNACAISES & COMMINGEOISES"),
+            ("armies_groups", "ARMÉES ET GROUPES"),
+            ("villagers", "LISTE DES VILLAGEOIS & DÉMÉNAGEMENTS"),
+        ):
+            entete = titre.format(label)
+            self._titres[cle] = (entete + "\n\n", entete + compteur + "\n\n")
+        self._entete = "[quote][center][b][size=18]{}[/size]\nRapport de la maréchaussée du {}.[/b][/center]\n\n"
+        self._fin_section = "\n\n\n"
+        self._ouverture_spoiler = "[spoiler][quote]Déménagements[/quote]\n"
+        self._fermeture_spoiler = "\n[/spoiler]\n\n\n"
+        self._legende = self.LEGENDE + "\n[/quote]"
+
+    def _titre(self, cle, count=None):
+        sans, avec = self._titres[cle]
+        return sans if count is None else avec.format(count)
+
+    def iter_rendu(self, village_name, d, mem_visions, surveillance, flux, etrangers,
+                   ac_presence, armies_groups, villagers, moves, analyse=None, noms=None):
+        date_str = d.strftime("%d %B %Y") if d else "Date inconnue"
+        yield self._entete.format(village_name, date_str)
+        analyse = analyse or {}
+        noms = noms or {}
+
+        bloc_mv = bloc_memoire_visions(mem_visions, analyse.get("mem_visions")) if mem_visions.strip() else []
+        yield self._titre("mem_visions")
+        yield '\n'.join(bloc_mv) if bloc_mv else RAS
+        yield self._fin_section
+
+        bloc_surv = bloc_surveillance(surveillance, analyse.get("surveillance")) if surveillance.strip() else []
+        yield self._titre("surveillance", len(bloc_surv) or count_lines(RAS))
+        yield '\n'.join(bloc_surv) if bloc_surv else RAS
+        yield self._fin_section
+
+        for cle, brut in (("flux", flux), ("etrangers", etrangers),
+                          ("ac_presence", ac_presence), ("armies_groups", armies_groups)):
+            yield self._titre(cle, count_lines(brut))
+            yield enrichir_bloc(brut, noms.get(cle))
+            yield self._fin_section
+
+        yield self._titre("villagers")
+        yield self._ouverture_spoiler
+        yield enrichir_bloc(moves, noms.get("moves"))
+        yield '\n'
+        yield enrichir_bloc(villagers, noms.get("villagers"))
+        yield self._fermeture_spoiler
+        yield self._legende
+
+    def rendre(self, *args, **kwargs):
+        tampon = io.StringIO()
+        for morceau in self.iter_rendu(*args, **kwargs):
+            tampon.write(morceau)
+        return tampon.getvalue()
+
+GABARIT_RAPPORT = GabaritRapport()
+
+def bbcode_report(village_name, d, mem_visions, surveillance, flux, etrangers, ac_presence, armies_groups, villagers, moves,
+                  analyse=None, noms=None):
+    return GABARIT_RAPPORT.rendre(village_name, d, mem_visions, surveillance, flux, etrangers,
+                                  ac_presence, armies_groups, villagers, moves, analyse=analyse, noms=noms)
+
+def iter_bbcode_report(village_name, d, mem_visions, surveillance, flux, etrangers, ac_presence, armies_groups, villagers, moves):
+    # Variante en flux : le BBCode est produit section par section
+    return GABARIT_RAPPORT.iter_rendu(village_name, d, mem_visions, surveillance, flux, etrangers,
+                                      ac_presence, armies_groups, villagers, moves)
 
 # ---------------------------------------------------------------------
 # Contexte global pour les templates
 # ---------------------------------------------------------------------
-@app.context_processor
+@bp.app_context_processor
 def inject_globals():
     return dict(
         SITE_NAME=SITE_NAME,
@@ -405,47 +1477,80 @@ def inject_globals():
 # ---------------------------------------------------------------------
 # Routes UI (propres)
 # ---------------------------------------------------------------------
-@app.route("/")
+@bp.route("/")
 def home():
     # Si l'utilisateur est déjà connecté, on le redirige selon son rôle
     if current_user.is_authenticated:
         if current_user.role == "marechal":
-            return redirect(url_for("rapport"))
+            return redirect(url_for("douanes.rapport"))
         elif current_user.role in ["prevot", "superadmin"]:
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("douanes.dashboard"))
     # Sinon, on affiche la page d'accueil classique
     return render_template("index.html")
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         u = request.form.get("username")
         p = request.form.get("password")
         remember = request.form.get("remember") == "on"
-        user = User.query.filter_by(username=u).first()
-        if not user or not user.check_password(p):
+        user = User.query.filter_by(username=u).first()  # username unique : index
+        ok = verifier_mot_de_passe(user.password_hash if user else hash_leurre(), p or "")
+        if ok is None:
+            flash("Trop de connexions simultanées, réessayez dans quelques secondes.")
+            resp = make_response(render_template("login.html"), 503)
+            resp.headers["Retry-After"] = "5"
+            return resp
+        if not user or not ok:
             flash("Identifiants incorrects.")
             return render_template("login.html")
+        if user.doit_rehacher():
+            # Migration transparente vers la politique PASSWORD_HASH_METHOD
+            user.set_password(p)
+            db.session.commit()
+            invalider_utilisateurs()
         login_user(user, remember=remember)
+        memoriser_utilisateur(user)
 
         # Redirection selon rôle après connexion
         if user.role == "marechal":
-            return redirect(url_for("rapport"))
+            return redirect(url_for("douanes.rapport"))
         elif user.role in ["prevot", "superadmin"]:
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("douanes.dashboard"))
         else:
-            return redirect(url_for("home"))
+            return redirect(url_for("douanes.home"))
 
     return render_template("login.html")
 
-@app.route("/logout")
+@bp.route("/healthz")
+def healthz():
+    # Sonde de l'hébergeur : base joignable et état du pool (sans authentification, sans données)
+    etat = {"status": "ok"}
+    code = 200
+    try:
+        db.session.execute(text("SELECT 1"))
+    except Exception as e:
+        db.session.rollback()
+        etat, code = {"status": "erreur", "error": type(e).__name__}, 503
+    pool = db.engine.pool
+    if hasattr(pool, "checkedout"):
+        etat["pool"] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+    return jsonify(etat), code
+
+@bp.route("/logout")
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for("home"))
+    session.pop("utilisateur", None)
+    return redirect(url_for("douanes.home"))
 
 # ---------- Lecture des guides : renvoie du HTML à injecter en modale ----------
-@app.route("/guide/<audience>")
+@bp.route("/guide/<audience>")
 @login_required
 def guide_read(audience):
     role = getattr(current_user, "role", "")
@@ -459,41 +1564,39 @@ def guide_read(audience):
     g = Guide.query.filter_by(audience=audience).first()
     if not g:
         return "<em>Guide introuvable.</em>", 404
-    html = render_markdown_safe(g.content)
-    return html
+    resp = make_response(guide_html(g))
+    resp.set_etag(g.content_hash)
+    resp.last_modified = g.updated_at
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
 
 # ---------- Routeur de tableaux de bord ----------
-@app.route("/dashboard")
+@bp.route("/dashboard")
 @login_required
 def dashboard():
     role = getattr(current_user, "role", "")
     if role == "superadmin":
-        return redirect(url_for("admin_dashboard"))
+        return redirect(url_for("douanes.admin_dashboard"))
     elif role == "prevot":
-        return redirect(url_for("prevot_dashboard"))
+        return redirect(url_for("douanes.prevot_dashboard"))
     else:
-        return redirect(url_for("rapport"))
+        return redirect(url_for("douanes.rapport"))
+
+def fragment_menu(gabarit):
+    # Menus de tableau de bord : ne dépendent que du rôle (déjà vérifié), rendus une fois par version
+    return Markup(cache.lire("fragments", gabarit, lambda: render_template(gabarit)))
 
 # ---------------------------------------------------------------------
 # Administration simple (superadmin)
 # ---------------------------------------------------------------------
-@app.route("/admin/dashboard")
+@bp.route("/admin/dashboard")
 @login_required
 def admin_dashboard():
     if not is_superadmin():
         abort(403)
-    return render_template_string("""
-    {% extends "base.html" %}{% block content %}
-    <h1>Tableau de bord — Superadmin</h1>
-    <ul>
-      <li><a href="{{ url_for('admin_users') }}">Gérer les utilisateurs</a></li>
-      <li><a href="{{ url_for('admin_guides') }}">Gérer les guides</a></li>
-      <li><a href="{{ url_for('prevot_dashboard') }}">Tableau de bord Prévôt</a></li>
-    </ul>
-    {% endblock %}
-    """)
-
-@app.route("/admin/guides", methods=["GET", "POST"])
+    return render_template("admin_dashboard.html", menu=fragment_menu("admin_menu.html"))
+
+@bp.route("/admin/guides", methods=["GET", "POST"])
 @login_required
 def admin_guides():
     if not is_superadmin():
@@ -503,53 +1606,20 @@ def admin_guides():
     if request.method == "POST":
         new_gm = request.form.get("content_marechal", "")
         new_gp = request.form.get("content_prevot", "")
-        if gm:
-            gm.content = new_gm
-            gm.updated_by = current_user.username
-        if gp:
-            gp.content = new_gp
-            gp.updated_by = current_user.username
+        for g, contenu in ((gm, new_gm), (gp, new_gp)):
+            if g and g.content != contenu:
+                g.content = contenu
+                g.content_html = render_markdown_safe(contenu)
+                g.content_hash = empreinte(contenu)
+                g.updated_by = current_user.username
         db.session.commit()
         flash("Guides enregistrés.")
-        return redirect(url_for("admin_guides"))
-    gm_html = render_markdown_safe(gm.content if gm else "")
-    gp_html = render_markdown_safe(gp.content if gp else "")
-    return render_template_string("""
-    {% extends "base.html" %}{% block content %}
-    <h1>Gérer les guides</h1>
-    <p><em>(Édition réservée au Super-admin)</em></p>
-    {% with msgs = get_flashed_messages() %}
-      {% if msgs %}{% for m in msgs %}<div class="flash">{{ m }}</div>{% endfor %}{% endif %}
-    {% endwith %}
-    <form method="post" style="display:grid;gap:1rem;grid-template-columns:1fr 1fr;align-items:start">
-      <div>
-        <h3>Guide maréchal (Markdown)</h3>
-        <textarea name="content_marechal" style="width:100%;height:300px">{{ (gm.content if gm else '')|e }}</textarea>
-        <h4>Aperçu</h4>
-        <div id="preview_marechal" style="background:#fff3; padding:.6rem; border:1px solid #0002">{{ gm_html|safe }}</div>
-      </div>
-      <div>
-        <h3>Guide prévôt (Markdown)</h3>
-        <textarea name="content_prevot" style="width:100%;height:300px">{{ (gp.content if gp else '')|e }}</textarea>
-        <h4>Aperçu</h4>
-        <div id="preview_prevot" style="background:#fff3; padding:.6rem; border:1px solid #0002">{{ gp_html|safe }}</div>
-      </div>
-      <div style="grid-column:1/-1">
-        <button type="submit">Enregistrer</button>
-      </div>
-    </form>
-    <script>
-      const pm = document.querySelector("textarea[name='content_marechal']");
-      const pp = document.querySelector("textarea[name='content_prevot']");
-      const vm = document.getElementById("preview_marechal");
-      const vp = document.getElementById("preview_prevot");
-      if (pm && vm) pm.addEventListener("input", ()=>{ vm.innerHTML = "<em>Aperçu mis à jour après enregistrement.</em>"; });
-      if (pp && vp) pp.addEventListener("input", ()=>{ vp.innerHTML = "<em>Aperçu mis à jour après enregistrement.</em>"; });
-    </script>
-    {% endblock %}
-    """, gm=gm, gp=gp, gm_html=gm_html, gp_html=gp_html)
-
-@app.route("/admin/users", methods=["GET", "POST"], endpoint="admin_users")
+        return redirect(url_for("douanes.admin_guides"))
+    gm_html = guide_html(gm) if gm else ""
+    gp_html = guide_html(gp) if gp else ""
+    return render_template("admin_guides.html", gm=gm, gp=gp, gm_html=gm_html, gp_html=gp_html)
+
+@bp.route("/admin/users", methods=["GET", "POST"], endpoint="admin_users")
 @login_required
 def admin_users():
     if not is_superadmin():
@@ -562,8 +1632,9 @@ def admin_users():
                 if user and user.role != "superadmin":
                     db.session.delete(user)
             db.session.commit()
+            invalider_utilisateurs()
             flash("Comptes supprimés.")
-            return redirect(url_for("admin_users"))
+            return redirect(url_for("douanes.admin_users"))
         uname = (request.form.get("username") or "").strip()
         pwd = (request.form.get("password") or "").strip()
         role = (request.form.get("role") or "marechal").strip()
@@ -578,7 +1649,7 @@ def admin_users():
             db.session.add(u)
             db.session.commit()
             flash(f"Utilisateur {uname} ({role}, {bureau}) créé.")
-        return redirect(url_for("admin_users"))
+        return redirect(url_for("douanes.admin_users"))
     users = (
         User.query
         .filter(User.role != "superadmin")
@@ -590,38 +1661,25 @@ def admin_users():
 # ---------------------------------------------------------------------
 # Tableau de bord Prévôt
 # ---------------------------------------------------------------------
-@app.route("/prevot/dashboard")
+@bp.route("/prevot/dashboard")
 @login_required
 def prevot_dashboard():
     role = getattr(current_user, "role", "")
     if role not in ("prevot", "admin", "superadmin"):
         abort(403)
-    return render_template_string("""
-    {% extends "base.html" %}
-    {% block content %}
-    <h1>Tableau de bord — Prévôt</h1>
-    <ul>
-      <li><a href="{{ url_for('gestion_marechaux') }}">Gérer les maréchaux</a></li>
-      <li><a href="{{ url_for('rapports_du_jour') }}">Consulter les rapports du jour</a></li>
-      <li><a href="{{ url_for('rectifier_rapport') }}">Rectifier un rapport</a></li>
-      <li><a href="{{ url_for('synthese_douane') }}">Gérer la synthèse de douane</a></li>
-      <li><a href="{{ url_for('brigands') }}">Gérer les listes des brigands</a></li>
-      <li><a href="{{ url_for('tableau_gardes') }}">Tableau des gardes</a></li>
-    </ul>
-    {% endblock %}
-    """)
+    return render_template("prevot_dashboard.html", menu=fragment_menu("prevot_menu.html"))
 
 # ---------------------------------------------------------------------
 # Interfaces prévôtales
 # ---------------------------------------------------------------------
-@app.route("/brigands")
+@bp.route("/brigands")
 @login_required
 def brigands():
     if current_user.role not in ["prevot", "admin", "superadmin"]:
         abort(403)
     return render_template("brigands.html")
 
-@app.route("/prevot/marechaux", methods=["GET", "POST"], endpoint="gestion_marechaux")
+@bp.route("/prevot/marechaux", methods=["GET", "POST"], endpoint="gestion_marechaux")
 @login_required
 def gestion_marechaux():
     if current_user.role != "prevot":
@@ -634,8 +1692,9 @@ def gestion_marechaux():
             if user and user.role == "marechal" and user.bureau == bureau_ac:
                 db.session.delete(user)
         db.session.commit()
+        invalider_utilisateurs()
         flash("Maréchaux A&C supprimés.")
-        return redirect(url_for("gestion_marechaux"))
+        return redirect(url_for("douanes.gestion_marechaux"))
     if request.method == "POST" and not request.form.getlist("delete_user"):
         uname = (request.form.get("username") or "").strip()
         pwd = (request.form.get("password") or "").strip()
@@ -652,7 +1711,7 @@ def gestion_marechaux():
             db.session.add(u)
             db.session.commit()
             flash(f"Maréchal {uname} (A&C) créé.")
-        return redirect(url_for("gestion_marechaux"))
+        return redirect(url_for("douanes.gestion_marechaux"))
     users = (
         User.query
         .filter_by(role="marechal", bureau=bureau_ac)
@@ -661,68 +1720,476 @@ def gestion_marechaux():
     )
     return render_template("marechaux.html", users=users)
 
-def jour_actif():
-    now = datetime.now()
-    seuil = now.replace(hour=5, minute=0, second=0, microsecond=0)
-    if now < seuil:
-        return (now - timedelta(days=1)).date()
-    return now.date()
-
-@app.route("/prevot/rapports-jour", methods=["GET"], endpoint="rapports_du_jour")
+@bp.route("/prevot/rapports-jour", methods=["GET"], endpoint="rapports_du_jour")
 @login_required
 def rapports_du_jour():
     if current_user.role != "prevot":
         abort(403)
-    jour = jour_actif()
-    villages = Village.query.order_by(Village.nom.asc()).all()
+    jour = etat_jeu().jour
+    # Une seule requête : chaque village avec son rapport du jour (ou NULL)
+    lignes = (
+        db.session.query(Village.nom, func.min(Report.id))
+        .outerjoin(Report, and_(Report.village == Village.nom, Report.report_date == jour))
+        .group_by(Village.nom)
+        .order_by(Village.nom.asc())
+        .all()
+    )
     rapports_faits = []
     rapports_manquants = []
-    for village in villages:
-        rapport = Report.query.filter_by(village=village.nom, report_date=jour).first()
-        if rapport:
-            rapports_faits.append((village.nom, rapport.id))
+    for nom, rapport_id in lignes:
+        if rapport_id is not None:
+            rapports_faits.append((nom, rapport_id))
         else:
-            rapports_manquants.append(village.nom)
+            rapports_manquants.append(nom)
     return render_template("rapports_jour.html",
                            jour=jour,
                            faits=rapports_faits,
                            manquants=rapports_manquants)
 
-@app.route("/prevot/rectifier-rapport")
+@bp.route("/prevot/rectifier-rapport")
 @login_required
 def rectifier_rapport():
     if current_user.role != "prevot":
         abort(403)
-    return render_template_string("<h2>Rectification des rapports — à venir</h2>")
+    return render_template("rectifier_rapport.html")
 
-@app.route("/prevot/synthese-douane")
+@bp.route("/prevot/synthese-douane")
 @login_required
 def synthese_douane():
     if current_user.role != "prevot":
         abort(403)
-    return render_template_string("<h2>Synthèse de douane — à venir</h2>")
+    try:
+        jour = datetime.strptime(request.args.get("jour", ""), "%Y-%m-%d").date()
+    except ValueError:
+        jour = etat_jeu().jour
+    lignes = SyntheseJour.query.filter_by(report_date=jour).all()
+    lignes.sort(key=lambda l: (-GRAVITE_TYPOLOGIE.get(l.typologie, 0), l.nom_normalise))
+    return render_template(
+        "synthese_douane.html",
+        jour=jour, lignes=lignes, bbcode=bbcode_synthese(jour, lignes),
+        veille=(jour - timedelta(days=1)).isoformat(), lendemain=(jour + timedelta(days=1)).isoformat(),
+    )
 
-@app.route("/prevot/gardes")
+@bp.route("/prevot/gardes")
 @login_required
 def tableau_gardes():
     if current_user.role != "prevot":
         abort(403)
-    return render_template_string("<h2>Tableau des gardes — à venir</h2>")
+    try:
+        debut = datetime.strptime(request.args.get("mois", ""), "%Y-%m").date()
+    except ValueError:
+        debut = etat_jeu().jour.replace(day=1)
+    suivant = (debut + timedelta(days=32)).replace(day=1)
+    precedent = (debut - timedelta(days=1)).replace(day=1)
+    jours = [debut + timedelta(days=i) for i in range((suivant - debut).days)]
+
+    lignes = (
+        db.session.query(AgregatGarde, User.username)
+        .outerjoin(User, User.id == AgregatGarde.user_id)
+        .filter(AgregatGarde.report_date >= debut, AgregatGarde.report_date < suivant)
+        .all()
+    )
+    grille = {}
+    for agregat, marechal in lignes:
+        grille.setdefault(agregat.village, {})[agregat.report_date] = (agregat, marechal)
+    villages = sorted(set(noms_villages()) | set(grille))
+    return render_template(
+        "tableau_gardes.html",
+        debut=debut, jours=jours, villages=villages, grille=grille,
+        mois_precedent=precedent.strftime("%Y-%m"), mois_suivant=suivant.strftime("%Y-%m"),
+    )
+
+# ---------------------------------------------------------------------
+# Rendu asynchrone des rapports (optionnel : RAPPORT_RENDU_ASYNC=1)
+# ---------------------------------------------------------------------
+RAPPORT_RENDU_ASYNC = os.getenv("RAPPORT_RENDU_ASYNC", "0") == "1"
+RAPPORT_RENDU_WORKERS = int(os.getenv("RAPPORT_RENDU_WORKERS", "2"))
+RAPPORT_ATTENTE_MAX = 25.0
+# Rapport encore à rendre passé ce délai : rendu perdu (worker redémarré), un autre worker le relance
+RAPPORT_RENDU_RELANCE = int(os.getenv("RAPPORT_RENDU_RELANCE", "60"))
+
+# Rapports dont les tables dérivées restent à écrire par la tâche de rendu
+A_DERIVER = ("en_attente", "en_cours")
+
+_pool_rendu = None
+_rendus_en_cours = {}
+_rendus_lock = threading.Lock()
+
+def reserver_rendu(rapport_id):
+    # UPDATE conditionnel : un seul exécutant par rapport, tous workers confondus. Un rendu
+    # « en_cours » commencé depuis plus de RAPPORT_RENDU_RELANCE s (worker tué en plein
+    # rendu) peut être repris. Renvoie l'horodatage de début qui identifie l'exécutant.
+    maintenant = datetime.utcnow()
+    limite = maintenant - timedelta(seconds=RAPPORT_RENDU_RELANCE)
+    pris = db.session.execute(
+        update(Report)
+        .where(Report.id == rapport_id,
+               or_(Report.rendu_statut == "en_attente",
+                   and_(Report.rendu_statut == "en_cours", Report.rendu_debut < limite)))
+        .values(rendu_statut="en_cours", rendu_debut=maintenant)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return maintenant if pris == 1 else None
+
+def rendre_rapport(app, rapport_id):
+    # Tout le travail du dépôt, dans une transaction : analyse, noms connus, BBCode et tables
+    # dérivées. Validée seulement si ce rendu n'a pas été repris entre-temps.
+    with app.app_context():
+        debut = reserver_rendu(rapport_id)
+        if debut is None:
+            return
+        r = Report.query.options(undefer_group("contenu")).filter_by(id=rapport_id).first()
+        if not r:
+            return
+        try:
+            deriver_rapport(r)
+            fini = db.session.execute(
+                update(Report)
+                .where(Report.id == rapport_id, Report.rendu_statut == "en_cours",
+                       Report.rendu_debut == debut)
+                .values(rendu_statut="pret")
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if fini:
+                db.session.commit()
+            else:
+                db.session.rollback()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erreur lors du rendu du rapport {rapport_id} :", e)
+            db.session.execute(
+                update(Report).where(Report.id == rapport_id, Report.rendu_debut == debut)
+                .values(rendu_statut="erreur")
+            )
+            db.session.commit()
+
+def planifier_rendu(rapport_id):
+    # Pool créé à la première soumission (jamais dans le processus parent avant fork)
+    global _pool_rendu
+    with _rendus_lock:
+        if rapport_id in _rendus_en_cours:
+            return _rendus_en_cours[rapport_id]
+        if _pool_rendu is None:
+            _pool_rendu = ThreadPoolExecutor(max_workers=RAPPORT_RENDU_WORKERS,
+                                             thread_name_prefix="rendu-rapport")
+        future = _pool_rendu.submit(rendre_rapport, current_app._get_current_object(), rapport_id)
+        _rendus_en_cours[rapport_id] = future
+    future.add_done_callback(lambda f: _rendus_en_cours.pop(rapport_id, None))
+    return future
+
+def attendre_rendu(rapport_id, attente):
+    future = _rendus_en_cours.get(rapport_id)
+    if future and attente:
+        try:
+            future.result(timeout=attente)
+        except Exception:
+            pass
+
+def creer_rapport(donnees, user_id, jour):
+    # Ajoute le Report à la session (commit à la charge de l'appelant). Renvoie
+    # (rapport, bbcode) ; en mode asynchrone, seul le texte brut est enregistré et
+    # bbcode vaut None : planifier_rendu après commit fait le reste.
+    r = Report(report_date=jour, user_id=user_id, **donnees)
+    db.session.add(r)
+    if RAPPORT_RENDU_ASYNC:
+        r.rendu_statut = "en_attente"
+        return r, None
+    return r, deriver_rapport(r)
+
+def deriver_rapport(r):
+    # Un passage d'analyse et d'automate, partagé par le BBCode (r.bbcode, renvoyé) et les tables dérivées
+    analyse = analyser_rapport(r.mem_visions, r.surveillance)
+    noms = reperer_noms(r)
+    bb = r.bbcode = bbcode_report(r.village, r.report_date, r.mem_visions, r.surveillance, r.flux, r.etrangers,
+                       r.ac_presence, r.armies_groups, r.villagers, r.moves, analyse=analyse, noms=noms)
+    agreger_rapport(r, noms)
+    enregistrer_entrees(r, analyse)
+    enregistrer_observations(r, analyse, noms)
+    fusionner_synthese(r.report_date, personnes_rapport(r, analyse, noms))
+    return bb
+
+def lignes_entrees(r, analyse):
+    lignes = []
+    for section, entrees in analyse.items():
+        for position, e in enumerate(entrees):
+            lignes.append(dict(
+                report_id=r.id, report_date=r.report_date, village=r.village,
+                section=section, position=position, nom=e["nom_ig"][:150],
+                nom_normalise=normaliser_nom(e["nom_ig"])[:150], typologie=(e["typologie"] or "").lower()[:20],
+                organisation=e.get("organisation", "")[:150], faits=e.get("faits", ""),
+                statut=e.get("statut", "")[:80], est_ac=e["est_ac"]
+            ))
+    return lignes
+
+def enregistrer_entrees(r, analyse):
+    # Après agreger_rapport (flush) : r.id est connu
+    lignes = lignes_entrees(r, analyse)
+    if lignes:
+        db.session.execute(insert(ReportEntry), lignes)
+
+SECTIONS_AGREGAT = ("mem_visions", "surveillance", "flux", "etrangers", "ac_presence",
+                    "armies_groups", "villagers", "moves")
+
+def valeurs_agregat(r, noms=None):
+    noms = noms if noms is not None else reperer_noms(r)
+    valeurs = {f"nb_{cle}": count_lines(getattr(r, cle)) for cle in SECTIONS_AGREGAT}
+    signales = set()
+    for cle in SECTIONS_AGREGAT:
+        for _, _, entree in noms[cle]:
+            if entree.get("typologie"):
+                signales.add(entree["nom"])
+    valeurs["nb_signales"] = len(signales)
+    return valeurs
+
+def agreger_rapport(r, noms=None):
+    # Premier rapport du (village, jour) : il fait foi, comme dans rapports_du_jour.
+    # Les suivants ne font qu'incrémenter nb_rapports.
+    db.session.flush()
+    maj = (
+        update(AgregatGarde)
+        .where(AgregatGarde.report_date == r.report_date, AgregatGarde.village == r.village)
+        .values(nb_rapports=AgregatGarde.nb_rapports + 1)
+    )
+    if db.session.execute(maj).rowcount:
+        # Rendu asynchrone : les rapports peuvent être dérivés dans le désordre
+        db.session.execute(
+            update(AgregatGarde)
+            .where(AgregatGarde.report_date == r.report_date, AgregatGarde.village == r.village,
+                   AgregatGarde.rapport_id > r.id)
+            .values(rapport_id=r.id, user_id=r.user_id, tour_de_garde=r.tour_de_garde,
+                    **valeurs_agregat(r, noms))
+        )
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(AgregatGarde(
+                report_date=r.report_date, village=r.village, rapport_id=r.id,
+                user_id=r.user_id, tour_de_garde=r.tour_de_garde, **valeurs_agregat(r, noms)
+            ))
+    except IntegrityError:
+        # Dépôt concurrent pour le même village : la ligne existe désormais
+        db.session.execute(maj)
+
+RE_FIN_NOM_VILLAGEOIS = re.compile(r"\s*(?:\||\(|\[| [—–-] ).*$")
+
+def lignes_observations(r, analyse, noms=None):
+    """Personnes vues dans le rapport, une fois par section : entrées « | »,
+    noms connus relevés par l'automate dans les sections de detecter_noms,
+    et chaque ligne de la liste des villageois."""
+    vues = {}
+
+    def voir(nom, section):
+        nom = (nom or "").strip()[:150]
+        cle = normaliser_nom(nom)
+        if cle and (cle, section) not in vues:
+            vues[(cle, section)] = dict(
+                nom=nom, nom_normalise=cle[:150], report_date=r.report_date,
+                village=r.village, report_id=r.id, section=section
+            )
+
+    for section, entrees in analyse.items():
+        for e in entrees:
+            voir(e["nom_ig"], section)
+    sections = ("mem_visions", "villagers", "armies_groups")
+    noms = noms if noms is not None else reperer_noms(r, sections)
+    for section in sections:
+        for _, _, entree in noms[section]:
+            if entree["type"] == "brigand":
+                voir(entree["nom"], section)
+    for ligne in lignes_non_vides(r.villagers):
+        voir(RE_FIN_NOM_VILLAGEOIS.sub("", ligne), "villagers")
+    return list(vues.values())
+
+def enregistrer_observations(r, analyse, noms=None):
+    lignes = lignes_observations(r, analyse, noms)
+    if lignes:
+        db.session.execute(insert(Observation), lignes)
+
+# ---------------------------------------------------------------------
+# Synthèse de douane : un passage par rapport au dépôt, fusion par jour
+# ---------------------------------------------------------------------
+GRAVITE_TYPOLOGIE = {"": 0, "surveillance": 1, "liste noire": 2, "png": 3, "couronne": 4}
+
+def personnes_rapport(r, analyse=None, noms=None):
+    # Personnes à synthétiser : lignes de surveillance, plus les brigands listés
+    # relevés dans les armées/groupes et les déménagements
+    surveillance = analyse["surveillance"] if analyse else analyser_surveillance(r.surveillance)
+    personnes = [
+        dict(nom=e["nom_ig"], typologie=e["typologie"].lower(), organisation=e["organisation"],
+             statut=e["statut"], village=r.village)
+        for e in surveillance
+    ]
+    noms = noms if noms is not None else reperer_noms(r, ("armies_groups", "moves"))
+    for section in ("armies_groups", "moves"):
+        for _, _, entree in noms[section]:
+            if entree["type"] == "brigand" and entree["typologie"]:
+                personnes.append(dict(nom=entree["nom"], typologie=entree["typologie"],
+                                      organisation=entree["organisation"], statut="", village=r.village))
+    return personnes
+
+def _fusionner(ligne, p):
+    villages = set(json.loads(ligne.villages or "[]"))
+    villages.add(p["village"])
+    ligne.villages = json.dumps(sorted(villages), ensure_ascii=False)
+    if GRAVITE_TYPOLOGIE.get(p["typologie"], 0) > GRAVITE_TYPOLOGIE.get(ligne.typologie, 0):
+        ligne.typologie = p["typologie"]
+    if p["organisation"] and not ligne.organisation:
+        ligne.organisation = p["organisation"]
+    if p["statut"]:
+        ligne.statut = p["statut"]
+
+def fusionner_synthese(jour, personnes):
+    """Fusionne les personnes d'un rapport dans le résumé du jour (une requête de lecture)."""
+    par_nom = {}
+    for p in personnes:
+        par_nom.setdefault(normaliser_nom(p["nom"]), []).append(p)
+    if not par_nom:
+        return
+    for essai in (1, 2):
+        # FOR UPDATE : deux dépôts qui relèvent la même personne fusionnent l'un après l'autre
+        # (ordre fixe pour éviter les interblocages) ; populate_existing relit les lignes verrouillées
+        existantes = {
+            l.nom_normalise: l for l in
+            SyntheseJour.query.filter(SyntheseJour.report_date == jour,
+                                      SyntheseJour.nom_normalise.in_(list(par_nom)))
+            .order_by(SyntheseJour.nom_normalise)
+            .with_for_update().populate_existing()
+        }
+        try:
+            with db.session.begin_nested():
+                for cle, liste in par_nom.items():
+                    ligne = existantes.get(cle)
+                    if ligne is None:
+                        ligne = SyntheseJour(report_date=jour, nom=liste[0]["nom"], nom_normalise=cle,
+                                             typologie="", organisation="", statut="", villages="[]")
+                        db.session.add(ligne)
+                    for p in liste:
+                        _fusionner(ligne, p)
+            return
+        except IntegrityError:
+            # Un autre dépôt a créé la même personne entre-temps : on relit et on refusionne
+            if essai == 2:
+                raise
+
+def bbcode_synthese(jour, lignes):
+    titre = f"[color={REPORT_TITLE_COLOR}][size=14][b][u]PERSONNES SIGNALÉES[/u] :[/b][/size][/color]"
+    corps = [
+        generer_surveillance_bbcode(l.nom, l.typologie, l.organisation, "", l.statut)
+        + " — [i]" + ", ".join(json.loads(l.villages)) + "[/i]"
+        for l in lignes
+    ]
+    return (
+        f"[quote][center][b][size=18]Synthèse de douane — {BUREAU_NAME}[/size]\n"
+        f"Journée du {jour.strftime('%d %B %Y')}.[/b][/center]\n\n"
+        f"{titre} [color=blue][b]{len(corps)}[/b][/color]\n\n"
+        + ("\n".join(corps) or RAS)
+        + "\n\n\n" + GabaritRapport.LEGENDE + "\n[/quote]"
+    )
+
+# ---------------------------------------------------------------------
+# File des dépôts reçus pendant la maintenance (BLOCK_DEPOSITS_FROM -> TO)
+# ---------------------------------------------------------------------
+FILE_DEPOTS_BLOCAGE = os.getenv("FILE_DEPOTS_BLOCAGE", "1") == "1"
+DEPOTS_LOT = int(os.getenv("DEPOTS_LOT", "10"))
+DEPOTS_INTERVALLE = float(os.getenv("DEPOTS_INTERVALLE", "1.0"))
+
+def mettre_en_file(donnees, user_id, jour):
+    db.session.add(DepotEnAttente(user_id=user_id, jour_de_jeu=jour, donnees=json.dumps(donnees)))
+    db.session.commit()
+    demarrer_videur()
+
+def vider_depots(limite=DEPOTS_LOT):
+    """Enregistre au plus `limite` dépôts en file ; renvoie le nombre traité."""
+    ids = [
+        id_ for (id_,) in db.session.query(DepotEnAttente.id)
+        .filter_by(statut="en_attente").order_by(DepotEnAttente.id).limit(limite)
+    ]
+    traites = 0
+    for id_ in ids:
+        # Réservation atomique : un seul worker traite chaque dépôt
+        pris = db.session.execute(
+            update(DepotEnAttente)
+            .where(DepotEnAttente.id == id_, DepotEnAttente.statut == "en_attente")
+            .values(statut="en_cours")
+        ).rowcount
+        db.session.commit()
+        if not pris:
+            continue
+        depot = db.session.get(DepotEnAttente, id_)
+        donnees = json.loads(depot.donnees)
+        try:
+            deja = (
+                db.session.query(Report.id)
+                .filter_by(village=donnees["village"], report_date=depot.jour_de_jeu).first()
+            )
+            if deja:
+                depot.statut, depot.rapport_id = "doublon", deja[0]
+                db.session.commit()
+            else:
+                r, bb = creer_rapport(donnees, depot.user_id, depot.jour_de_jeu)
+                db.session.flush()
+                depot.statut, depot.rapport_id = "traite", r.id
+                db.session.commit()
+                if bb is None:
+                    planifier_rendu(depot.rapport_id)
+            traites += 1
+        except Exception as e:
+            db.session.rollback()
+            db.session.execute(
+                update(DepotEnAttente).where(DepotEnAttente.id == id_).values(statut="erreur", erreur=str(e))
+            )
+            db.session.commit()
+    return traites
+
+_videur = None
+_videur_lock = threading.Lock()
+_derniere_verif_file = 0.0
+
+def _boucle_videur(app):
+    # Vidage à débit limité (DEPOTS_LOT toutes les DEPOTS_INTERVALLE s) une fois le créneau rouvert
+    while True:
+        if is_blocked_now():
+            _time.sleep(30)
+            continue
+        with app.app_context():
+            vider_depots()
+            reste = db.session.query(DepotEnAttente.id).filter_by(statut="en_attente").first()
+        if not reste:
+            return
+        _time.sleep(DEPOTS_INTERVALLE)
+
+def demarrer_videur():
+    global _videur
+    with _videur_lock:
+        if _videur is None or not _videur.is_alive():
+            _videur = threading.Thread(target=_boucle_videur, args=(current_app._get_current_object(),),
+                                       name="videur-depots", daemon=True)
+            _videur.start()
+
+@bp.before_app_request
+def verifier_file_depots():
+    # Au plus une fois par minute et par worker : reprend une file laissée par un autre processus
+    global _derniere_verif_file
+    if not FILE_DEPOTS_BLOCAGE or _time.monotonic() - _derniere_verif_file < 60:
+        return
+    _derniere_verif_file = _time.monotonic()
+    if not is_blocked_now() and db.session.query(DepotEnAttente.id).filter_by(statut="en_attente").first():
+        demarrer_videur()
 
 # ---------------------------------------------------------------------
 # Formulaire Rapport Maréchal
 # ---------------------------------------------------------------------
 def get_villages_traite_today():
-    today = date.today()
-    rapports_du_jour = Report.query.filter_by(report_date=today).all()
-    return [r.village for r in rapports_du_jour]
+    return villages_traites(etat_jeu().jour)
 
-@app.route("/rapport", methods=["GET", "POST"])
+@bp.route("/rapport", methods=["GET", "POST"])
 @login_required
 def rapport():
-    villages = [v.nom for v in Village.query.order_by(Village.nom.asc()).all()]
-    blocked = is_blocked_now()
-    jour_de_jeu = get_jour_de_jeu()
+    villages = noms_villages()
+    etat = etat_jeu()
+    blocked = etat.bloque
+    jour_de_jeu = None if blocked else etat.jour
 
     def rerender():
         villages_traite_today = get_villages_traite_today()
@@ -732,11 +2199,12 @@ def rapport():
             blocked=blocked,
             form=request.form,
             villages_traite_today=villages_traite_today,
-            jour_de_jeu=jour_de_jeu
+            jour_de_jeu=jour_de_jeu,
+            file_ouverte=FILE_DEPOTS_BLOCAGE
         )
 
     if request.method == "POST":
-        if blocked:
+        if blocked and not FILE_DEPOTS_BLOCAGE:
             flash("Dépôt bloqué.")
             return rerender()
 
@@ -774,28 +2242,33 @@ def rapport():
         if not tour and not mv:
             mv = "Tour de garde non effectué (autres données fournies)."
 
-        bb = bbcode_report(village, jour_de_jeu, mv, surv, flux, etrangers, acp, ag, villagers, moves)
-
-        r = Report(
-            report_date=jour_de_jeu,
-            user_id=current_user.id,
+        donnees = dict(
             village=village,
             tour_de_garde=tour,
             mem_visions=mv,
             surveillance=surv,
             flux=flux,
-            foreigners=etrangers,
+            etrangers=etrangers,
             ac_presence=acp,
             armies_groups=ag,
             villagers=villagers,
-            moves=moves,
-            bbcode=bb
+            moves=moves
         )
-        db.session.add(r)
-        db.session.commit()
 
+        if blocked:
+            # Maintenance : le dépôt est mis en file et enregistré à la réouverture
+            jour = etat_jeu().jour_suivant
+            mettre_en_file(donnees, current_user.id, jour)
+            return render_template("report_result.html", bbcode=None, rapport_id=None, en_file=True,
+                                   village=village, date=jour.strftime("%d %B %Y"))
+
+        r, bb = creer_rapport(donnees, current_user.id, jour_de_jeu)
+        db.session.commit()
         date_str = jour_de_jeu.strftime("%d %B %Y") if jour_de_jeu else "Date inconnue"
-        return render_template("report_result.html", bbcode=bb, village=village, date=date_str)
+        if bb is None:
+            # Saisie enregistrée tout de suite ; le BBCode est rendu par le pool
+            planifier_rendu(r.id)
+        return render_template("report_result.html", bbcode=bb, rapport_id=r.id, village=village, date=date_str)
 
     villages_traite_today = get_villages_traite_today()
     return render_template(
@@ -804,13 +2277,39 @@ def rapport():
         blocked=blocked,
         form=None,
         villages_traite_today=villages_traite_today,
-        jour_de_jeu=jour_de_jeu
+        jour_de_jeu=jour_de_jeu,
+        file_ouverte=FILE_DEPOTS_BLOCAGE
     )
 
-@app.route("/rapport/<int:rapport_id>", methods=["GET"], endpoint="voir_rapport")
+@bp.route("/rapport/<int:rapport_id>/bbcode", methods=["GET"])
+@login_required
+def rapport_bbcode(rapport_id):
+    # Suivi du rendu asynchrone : attente longue (?attente=s) tant que le rendu tourne ici
+    if current_user.role not in ["prevot", "marechal", "superadmin", "admin"]:
+        abort(403)
+    try:
+        attente = max(0.0, min(float(request.args.get("attente", 0)), RAPPORT_ATTENTE_MAX))
+    except ValueError:
+        attente = 0.0
+    attendre_rendu(rapport_id, attente)
+    ligne = (
+        db.session.query(Report.rendu_statut, Report.bbcode, Report.created_at, Report.rendu_debut)
+        .filter(Report.id == rapport_id).first()
+    )
+    if not ligne:
+        abort(404)
+    statut, bbcode, cree_le, debut = ligne
+    # Jamais commencé depuis le dépôt, ou commencé puis abandonné (worker redémarré) :
+    # on le relance ; reserver_rendu écarte les doublons
+    depuis = {"en_attente": cree_le, "en_cours": debut}.get(statut)
+    if depuis and depuis < datetime.utcnow() - timedelta(seconds=RAPPORT_RENDU_RELANCE):
+        planifier_rendu(rapport_id)
+    return jsonify({"statut": statut, "bbcode": bbcode if statut == "pret" else None})
+
+@bp.route("/rapport/<int:rapport_id>", methods=["GET"], endpoint="voir_rapport")
 @login_required
 def voir_rapport(rapport_id):
-    rapport = Report.query.get_or_404(rapport_id)
+    rapport = rapport_complet_or_404(rapport_id)
     if current_user.role not in ["prevot", "marechal", "superadmin", "admin"]:
         abort(403)
     return render_template("rapport_lecture.html", rapport=rapport)
@@ -825,7 +2324,22 @@ def org_display_label(org: Organisation):
         return org.nom_abrege.strip()
     return org.nom_complet.strip()
 
-def brigand_to_json(b: Brigand):
+def organisation_to_json(org: Organisation, cache=None):
+    # cache : dict id -> JSON, pour ne sérialiser qu'une fois chaque organisation
+    if not org:
+        return None
+    if cache is not None and org.id in cache:
+        return cache[org.id]
+    data = {
+        "id": org.id,
+        "nom_complet": org.nom_complet,
+        "nom_abrege": org.nom_abrege
+    }
+    if cache is not None:
+        cache[org.id] = data
+    return data
+
+def brigand_to_json(b: Brigand, cache=None):
     return {
         "id": b.id,
         "nom": b.nom,
@@ -834,23 +2348,125 @@ def brigand_to_json(b: Brigand):
         "couronne": bool(b.recherche_couronne),
         "png": bool(b.est_png),
         "organisation_id": b.organisation_id,
-        "organisation": (
-            {
-                "id": b.organisation.id,
-                "nom_complet": b.organisation.nom_complet,
-                "nom_abrege": b.organisation.nom_abrege
-            } if b.organisation else None
-        )
+        "organisation": organisation_to_json(b.organisation, cache)
     }
 
-@app.route("/api/brigands")
+def brigands_to_json(brigands):
+    cache = {}
+    return [brigand_to_json(b, cache) for b in brigands]
+
+def requete_brigands_entites():
+    # Organisations chargées en une requête IN, quel que soit le nombre de brigands
+    return Brigand.query.options(selectinload(Brigand.organisation))
+
+SERIALISEURS_BRIGAND = {
+    "id": lambda l: l.id,
+    "nom": lambda l: l.nom,
+    "liste": lambda l: l.liste or "",
+    "faits": lambda l: l.faits or "",
+    "couronne": lambda l: bool(l.recherche_couronne),
+    "png": lambda l: bool(l.est_png),
+    "organisation_id": lambda l: l.organisation_id,
+    "organisation": lambda l: (
+        {
+            "id": l.organisation_id,
+            "nom_complet": l.org_nom_complet,
+            "nom_abrege": l.org_nom_abrege
+        } if l.org_nom_complet is not None else None
+    ),
+}
+
+def brigand_ligne_to_json(l, champs=None):
+    # Même forme que brigand_to_json, depuis une ligne de requete_brigands()
+    return {champ: SERIALISEURS_BRIGAND[champ](l) for champ in (champs or SERIALISEURS_BRIGAND)}
+
+BRIGANDS_PAGE_MAX = int(os.getenv("BRIGANDS_PAGE_MAX", "500"))
+
+def arg_booleen(nom):
+    val = request.args.get(nom)
+    if val is None or val == "":
+        return None
+    return val.lower() in ("1", "true", "oui", "on")
+
+def encoder_curseur(nom, id_):
+    return base64.urlsafe_b64encode(json.dumps([nom, id_]).encode()).decode()
+
+def decoder_curseur(curseur):
+    try:
+        nom, id_ = json.loads(base64.urlsafe_b64decode(curseur.encode()))
+        return str(nom), int(id_)
+    except Exception:
+        return None
+
+@bp.route("/api/brigands")
 @login_required
 def api_brigands():
     require_prevot_or_admin()
-    brigands = Brigand.query.order_by(Brigand.nom.asc()).all()
-    return jsonify([brigand_to_json(b) for b in brigands])
-
-@app.route("/api/brigands", methods=["POST"])
+    etag = "brigands-%d-%s" % (
+        version_table("brigand"),
+        hashlib.sha1(request.query_string).hexdigest()[:12]
+    )
+    if request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+
+    champs = None
+    if request.args.get("fields"):
+        champs = [c.strip() for c in request.args["fields"].split(",") if c.strip()]
+        inconnus = [c for c in champs if c not in SERIALISEURS_BRIGAND]
+        if inconnus:
+            return jsonify({"error": "Champs inconnus : " + ", ".join(inconnus)}), 400
+
+    q = requete_brigands(champs)
+    if request.args.get("liste") is not None:
+        q = q.filter(Brigand.liste == request.args["liste"])
+    couronne, png = arg_booleen("couronne"), arg_booleen("png")
+    if couronne is not None:
+        q = q.filter(Brigand.recherche_couronne.is_(couronne))
+    if png is not None:
+        q = q.filter(Brigand.est_png.is_(png))
+    if request.args.get("organisation_id"):
+        try:
+            q = q.filter(Brigand.organisation_id == int(request.args["organisation_id"]))
+        except ValueError:
+            return jsonify({"error": "organisation_id invalide"}), 400
+    prefixe = (request.args.get("prefixe") or "").strip()
+    if prefixe:
+        echappe = prefixe.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        q = q.filter(Brigand.nom.ilike(echappe + "%", escape="\\"))
+    q = q.order_by(Brigand.nom.asc(), Brigand.id.asc())
+
+    pagine = "limit" in request.args or "cursor" in request.args
+    if not pagine:
+        data = [brigand_ligne_to_json(l, champs) for l in q]
+    else:
+        try:
+            limit = max(1, min(int(request.args.get("limit", BRIGANDS_PAGE_MAX)), BRIGANDS_PAGE_MAX))
+        except ValueError:
+            return jsonify({"error": "limit invalide"}), 400
+        if request.args.get("cursor"):
+            curseur = decoder_curseur(request.args["cursor"])
+            if not curseur:
+                return jsonify({"error": "Curseur invalide"}), 400
+            nom, id_ = curseur
+            q = q.filter(or_(Brigand.nom > nom, and_(Brigand.nom == nom, Brigand.id > id_)))
+        lignes = q.limit(limit + 1).all()
+        suivant = None
+        if len(lignes) > limit:
+            lignes = lignes[:limit]
+            suivant = encoder_curseur(lignes[-1].nom, lignes[-1].id)
+        data = {
+            "items": [brigand_ligne_to_json(l, champs) for l in lignes],
+            "next_cursor": suivant
+        }
+    resp = jsonify(data)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+@bp.route("/api/brigands", methods=["POST"])
 @login_required
 def create_brigand():
     require_prevot_or_admin()
@@ -886,30 +2502,35 @@ def create_brigand():
 
     try:
         db.session.add(brigand)
+        incrementer_version("brigand")
         db.session.commit()
+        index_noms.maj_brigand(brigand)
         return jsonify({"success": True, "id": brigand.id, "brigand": brigand_to_json(brigand)})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/brigands/search")
+@bp.route("/api/brigands/search")
 @login_required
 def search_brigand_by_name():
     require_prevot_or_admin()
     nom = (request.args.get("nom", "") or "").strip()
     if not nom:
         return jsonify({"error": "Nom IG manquant"}), 400
-    brigand = Brigand.query.filter_by(nom=nom).first()
+    brigand = (
+        Brigand.query.options(joinedload(Brigand.organisation))
+        .filter_by(nom=nom).first()
+    )
     if not brigand:
         return jsonify({"error": "Brigand introuvable"}), 404
     return jsonify(brigand_to_json(brigand))
 
-@app.route("/api/brigands/<int:brigand_id>", methods=["PUT"])
+@bp.route("/api/brigands/<int:brigand_id>", methods=["PUT"])
 @login_required
 def update_brigand(brigand_id):
     require_prevot_or_admin()
     data = request.get_json() or {}
-    brigand = Brigand.query.get(brigand_id)
+    brigand = requete_brigands_entites().filter_by(id=brigand_id).first()
     if not brigand:
         return jsonify({"error": "Brigand introuvable"}), 404
 
@@ -951,13 +2572,17 @@ def update_brigand(brigand_id):
         brigand.organisation_id = resolved_id
 
     try:
+        incrementer_version("brigand")
         db.session.commit()
+        index_noms.maj_brigand(brigand)
         return jsonify({"success": True, "brigand": brigand_to_json(brigand)})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/brigands/delete-by-name", methods=["POST"])
+BATCH_DELETE_MAX = int(os.getenv("BATCH_DELETE_MAX", "500"))
+
+@bp.route("/api/brigands/delete-by-name", methods=["POST"])
 @login_required
 def delete_brigands_by_name():
     require_prevot_or_admin()
@@ -965,34 +2590,371 @@ def delete_brigands_by_name():
     noms = data.get("noms", [])
     if not isinstance(noms, list) or not noms:
         return jsonify({"error": "Liste de noms invalide"}), 400
+    noms = list(dict.fromkeys(n for n in (str(x or "").strip() for x in noms) if n))
     deleted = []
-    for nom in noms:
-        b = Brigand.query.filter_by(nom=(nom or "").strip()).first()
-        if b:
-            db.session.delete(b)
-            deleted.append(nom)
+    count = 0
     try:
+        # Un DELETE ... WHERE nom IN (...) par lot, validé aussitôt : verrous courts,
+        # aucune entité chargée dans la session
+        for k in range(0, len(noms), BATCH_DELETE_MAX):
+            lot = noms[k:k + BATCH_DELETE_MAX]
+            requete = delete(Brigand).where(Brigand.nom.in_(lot))
+            if db.engine.dialect.delete_returning:
+                supprimes = db.session.execute(requete.returning(Brigand.nom),
+                                               execution_options={"synchronize_session": False}).all()
+                trouves = {nom for (nom,) in supprimes}
+                count += len(supprimes)
+            else:
+                trouves = {nom for (nom,) in db.session.query(Brigand.nom).filter(Brigand.nom.in_(lot)).distinct()}
+                res = db.session.execute(requete, execution_options={"synchronize_session": False})
+                count += res.rowcount
+            if trouves:
+                incrementer_version("brigand")
+            db.session.commit()
+            for nom in lot:
+                if nom in trouves:
+                    deleted.append(nom)
+                    index_noms.oublier(nom)
+        return jsonify({"success": True, "deleted": deleted, "count": count})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e), "deleted": deleted, "count": count}), 500
+
+# ---------- Import en masse ----------
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "10000"))
+
+def valeur_booleenne(val):
+    if isinstance(val, str):
+        return val.strip().lower() in ("1", "true", "oui", "x", "on")
+    return bool(val)
+
+def lire_import_brigands():
+    # Tableau JSON (ou {"brigands": [...]}) ou fichier CSV (champ « fichier », séparateur , ou ;)
+    fichier = request.files.get("fichier")
+    if fichier:
+        brut = fichier.read()
+        # Export Excel français : souvent en cp1252 plutôt qu'en UTF-8
+        for encodage in ("utf-8-sig", "cp1252"):
+            try:
+                contenu = brut.decode(encodage)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            return None
+        try:
+            dialecte = csv.Sniffer().sniff(contenu.split("\n", 1)[0], delimiters=",;")
+        except csv.Error:
+            dialecte = csv.excel
+        lecteur = csv.DictReader(io.StringIO(contenu), dialect=dialecte)
+        return [
+            {(k or "").strip().lower(): (v or "").strip() for k, v in ligne.items() if k}
+            for ligne in lecteur
+        ]
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get("brigands")
+    return data if isinstance(data, list) else None
+
+@bp.route("/api/brigands/import", methods=["POST"])
+@login_required
+def import_brigands():
+    require_prevot_or_admin()
+    lignes = lire_import_brigands()
+    if lignes is None:
+        return jsonify({"error": "Envoyez un tableau JSON ou un fichier CSV"}), 400
+    if len(lignes) > BULK_MAX_ROWS:
+        return jsonify({"error": f"Import limité à {BULK_MAX_ROWS} lignes"}), 413
+
+    resultats = [None] * len(lignes)
+    retenues = {}
+    for i, ligne in enumerate(lignes):
+        if not isinstance(ligne, dict) or not str(ligne.get("nom") or "").strip():
+            resultats[i] = {"ligne": i + 1, "statut": "erreur", "erreur": "Le nom IG est obligatoire"}
+            continue
+        nom = str(ligne["nom"]).strip()
+        if nom in retenues:
+            precedente = retenues[nom]
+            resultats[precedente] = {"ligne": precedente + 1, "nom": nom, "statut": "ignoré",
+                                     "erreur": f"Remplacée par la ligne {i + 1}"}
+        retenues[nom] = i
+
+    # Organisations désignées par leur nom : une seule requête pour tout l'import
+    noms_orgs = {
+        str(lignes[i].get("organisation") or "").strip()
+        for i in retenues.values() if str(lignes[i].get("organisation") or "").strip()
+    }
+    orgs = {}
+    if noms_orgs:
+        for org_id, nom_abrege, nom_complet in db.session.query(
+            Organisation.id, Organisation.nom_abrege, Organisation.nom_complet
+        ).filter(or_(Organisation.nom_abrege.in_(noms_orgs), Organisation.nom_complet.in_(noms_orgs))):
+            orgs.setdefault(nom_complet, org_id)
+            if nom_abrege:
+                orgs.setdefault(nom_abrege, org_id)
+
+    noms = list(retenues)
+    existants = {}
+    for k in range(0, len(noms), BULK_BATCH_SIZE):
+        for brigand_id, nom in db.session.query(Brigand.id, Brigand.nom).filter(
+            Brigand.nom.in_(noms[k:k + BULK_BATCH_SIZE])
+        ):
+            existants.setdefault(nom, []).append(brigand_id)
+
+    a_inserer, a_modifier = [], []
+    for nom, i in retenues.items():
+        ligne = lignes[i]
+        valeurs = {"nom": nom, "nom_normalise": normaliser_nom(nom)}
+        if "liste" in ligne:
+            valeurs["liste"] = str(ligne.get("liste") or "").strip()
+        if "faits" in ligne:
+            valeurs["faits"] = str(ligne.get("faits") or "").strip()
+        if "couronne" in ligne:
+            valeurs["recherche_couronne"] = valeur_booleenne(ligne.get("couronne"))
+        if "png" in ligne:
+            valeurs["est_png"] = valeur_booleenne(ligne.get("png"))
+        resultat = {"ligne": i + 1, "nom": nom}
+        if str(ligne.get("organisation_id") or "").strip():
+            try:
+                valeurs["organisation_id"] = int(ligne["organisation_id"])
+            except (TypeError, ValueError):
+                resultats[i] = {**resultat, "statut": "erreur", "erreur": "organisation_id invalide"}
+                continue
+        elif "organisation" in ligne or "organisation_id" in ligne:
+            legacy = str(ligne.get("organisation") or "").strip()
+            valeurs["organisation_id"] = orgs.get(legacy)
+            if legacy and legacy not in orgs:
+                resultat["avertissement"] = f"Organisation inconnue : {legacy}"
+        if nom in existants:
+            a_modifier.extend({**valeurs, "id": brigand_id} for brigand_id in existants[nom])
+            resultats[i] = {**resultat, "statut": "mis à jour"}
+        else:
+            a_inserer.append(valeurs)
+            resultats[i] = {**resultat, "statut": "créé"}
+
+    try:
+        # Une seule transaction ; executemany par lots de BULK_BATCH_SIZE
+        for k in range(0, len(a_inserer), BULK_BATCH_SIZE):
+            db.session.execute(insert(Brigand), a_inserer[k:k + BULK_BATCH_SIZE])
+        for k in range(0, len(a_modifier), BULK_BATCH_SIZE):
+            db.session.execute(update(Brigand), a_modifier[k:k + BULK_BATCH_SIZE])
+        if a_inserer or a_modifier:
+            incrementer_version("brigand")
         db.session.commit()
-        return jsonify({"success": True, "deleted": deleted})
+        index_noms.invalider()
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
+    return jsonify({
+        "success": True,
+        "crees": sum(1 for r in resultats if r["statut"] == "créé"),
+        "mis_a_jour": sum(1 for r in resultats if r["statut"] == "mis à jour"),
+        "erreurs": sum(1 for r in resultats if r["statut"] == "erreur"),
+        "resultats": resultats
+    })
+
+# ---------- Recherche floue ----------
+RECHERCHE_SEUIL = float(os.getenv("RECHERCHE_SEUIL", "0.3"))
+RECHERCHE_PREFIXE_MAX = 200
+
+PARTICULES = {"de", "du", "d", "le", "la", "des", "l"}
+
+def trigrammes(texte):
+    # Même découpage que pg_trgm (mots alphanumériques bordés de « ␣␣ » et « ␣ »),
+    # sans les particules : « de », « d’ »... sont communes à trop de noms
+    tri = set()
+    for mot in re.findall(r"[^\W_]+", texte):
+        if mot in PARTICULES:
+            continue
+        mot = f"  {mot} "
+        tri.update(mot[i:i + 3] for i in range(len(mot) - 2))
+    return tri
+
+def formes_recherche(q):
+    # Le nom saisi, et le nom réel s'il est suivi d'un titre (« Agatha de Lectoure » -> « agatha »)
+    q = normaliser_nom(q)
+    formes = [q]
+    nom_split = q.split()
+    if len(nom_split) > 1 and nom_split[1].replace("'", "’") in TITRES_PACK:
+        formes.append(nom_split[0])
+    return formes
+
+class IndexTrigrammes:
+    """Index n-grammes en mémoire des noms de brigands (SQLite, ou PostgreSQL
+    sans pg_trgm). Reconstruit quand la version de la table brigand change."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._ids = []
+        self._noms = []
+        self._tailles = []
+        self._postings = {}
+        self._tries = []
+
+    def _construire(self, version):
+        ids, noms, tailles, postings = [], [], [], {}
+        for id_, nom in db.session.query(Brigand.id, Brigand.nom_normalise):
+            nom = nom or ""
+            pos = len(ids)
+            ids.append(id_)
+            noms.append(nom)
+            tri = trigrammes(nom)
+            tailles.append(len(tri))
+            for t in tri:
+                postings.setdefault(t, set()).add(pos)
+        self._ids, self._noms, self._tailles, self._postings = ids, noms, tailles, postings
+        self._tries = sorted((nom, pos) for pos, nom in enumerate(noms))
+        self._version = version
+
+    def rechercher(self, q, limit=10, seuil=RECHERCHE_SEUIL):
+        version = version_table("brigand")
+        with self._lock:
+            if version != self._version:
+                self._construire(version)
+            scores = {}
+            vide = frozenset()
+            for forme in formes_recherche(q):
+                # Filtrage par préfixe : un nom de similarité >= seuil partage au moins m
+                # trigrammes avec la requête, donc au moins un des (|tq| - m + 1) plus rares.
+                tq = sorted(trigrammes(forme), key=lambda t: len(self._postings.get(t, vide)))
+                m = max(1, math.ceil(seuil * len(tq)))
+                communs = Counter()
+                for t in tq[:len(tq) - m + 1]:
+                    communs.update(self._postings.get(t, vide))
+                for t in tq[len(tq) - m + 1:]:
+                    communs.update(communs.keys() & self._postings.get(t, vide))
+                tailles = self._tailles
+                for pos, n in communs.items():
+                    if n >= m:
+                        sim = n / (len(tq) + tailles[pos] - n)
+                        if sim >= seuil and sim > scores.get(pos, 0):
+                            scores[pos] = sim
+                # Préfixe insensible aux accents : bonus de classement (balayage borné)
+                i = bisect.bisect_left(self._tries, (forme, -1))
+                fin = min(i + RECHERCHE_PREFIXE_MAX, len(self._tries))
+                while i < fin and self._tries[i][0].startswith(forme):
+                    pos = self._tries[i][1]
+                    scores[pos] = max(scores.get(pos, 0), 1 + len(forme) / max(len(self._noms[pos]), 1))
+                    i += 1
+            meilleurs = sorted(scores.items(), key=lambda kv: (-kv[1], self._noms[kv[0]]))[:limit]
+            return [(self._ids[pos], round(min(score, 1.0), 3), score >= 1) for pos, score in meilleurs]
+
+index_trigrammes = IndexTrigrammes()
+
+def rechercher_brigands_pg(q, limit=10, seuil=RECHERCHE_SEUIL):
+    resultats = {}
+    for forme in formes_recherche(q):
+        prefixe = forme.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        est_prefixe = Brigand.nom_normalise.like(prefixe, escape="\\")
+        lignes = (
+            db.session.query(Brigand.id, func.similarity(Brigand.nom_normalise, forme), est_prefixe)
+            .filter(or_(Brigand.nom_normalise.op("%")(forme), est_prefixe))
+            .order_by(est_prefixe.desc(), func.similarity(Brigand.nom_normalise, forme).desc())
+            .limit(limit)
+        )
+        for id_, sim, pref in lignes:
+            score = (1 if pref else 0) + (sim or 0)
+            if (pref or (sim or 0) >= seuil) and score > resultats.get(id_, (0,))[0]:
+                resultats[id_] = (score, bool(pref), sim or 0)
+    meilleurs = sorted(resultats.items(), key=lambda kv: -kv[1][0])[:limit]
+    return [(id_, round(float(sim), 3) if not pref else 1.0, pref) for id_, (_, pref, sim) in meilleurs]
+
+@bp.route("/api/brigands/recherche")
+@login_required
+def recherche_brigands():
+    require_prevot_or_admin()
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"error": "Paramètre q manquant"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 10)), 50))
+    except ValueError:
+        return jsonify({"error": "limit invalide"}), 400
+    if trgm_disponible():
+        trouves = rechercher_brigands_pg(q, limit)
+    else:
+        trouves = index_trigrammes.rechercher(q, limit)
+    if not trouves:
+        return jsonify([])
+    champs = ["id", "nom", "liste", "couronne", "png", "organisation"]
+    lignes = {l.id: l for l in requete_brigands(champs).filter(Brigand.id.in_([t[0] for t in trouves]))}
+    return jsonify([
+        {**brigand_ligne_to_json(lignes[id_], champs), "score": score, "prefixe": prefixe}
+        for id_, score, prefixe in trouves if id_ in lignes
+    ])
+
+# ---------- Historique des passages ----------
+SIGHTINGS_PAGE_MAX = int(os.getenv("SIGHTINGS_PAGE_MAX", "1000"))
+
+def arg_date(nom):
+    val = request.args.get(nom)
+    if not val:
+        return None
+    return datetime.strptime(val, "%Y-%m-%d").date()
+
+@bp.route("/api/sightings")
+@login_required
+def api_sightings():
+    """Passages d'une personne, triés par jour, en NDJSON (une observation par
+    ligne). Le curseur de la page suivante est dans l'en-tête X-Next-Cursor."""
+    require_prevot_or_admin()
+    nom = normaliser_nom(request.args.get("nom"))
+    if not nom:
+        return jsonify({"error": "Paramètre nom obligatoire"}), 400
+    try:
+        du, au = arg_date("from"), arg_date("to")
+    except ValueError:
+        return jsonify({"error": "Dates attendues au format AAAA-MM-JJ"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", SIGHTINGS_PAGE_MAX)), SIGHTINGS_PAGE_MAX))
+    except ValueError:
+        return jsonify({"error": "limit invalide"}), 400
+
+    q = db.session.query(
+        Observation.id, Observation.nom, Observation.report_date, Observation.village,
+        Observation.report_id, Observation.section
+    ).filter(Observation.nom_normalise == nom)
+    if du:
+        q = q.filter(Observation.report_date >= du)
+    if au:
+        q = q.filter(Observation.report_date <= au)
+    if request.args.get("cursor"):
+        curseur = decoder_curseur(request.args["cursor"])
+        try:
+            jour, id_ = date.fromisoformat(curseur[0]), curseur[1]
+        except (TypeError, ValueError):
+            return jsonify({"error": "Curseur invalide"}), 400
+        q = q.filter(or_(Observation.report_date > jour,
+                         and_(Observation.report_date == jour, Observation.id > id_)))
+    lignes = q.order_by(Observation.report_date.asc(), Observation.id.asc()).limit(limit + 1).all()
+    suivant = None
+    if len(lignes) > limit:
+        lignes = lignes[:limit]
+        suivant = encoder_curseur(lignes[-1].report_date.isoformat(), lignes[-1].id)
+
+    def generer():
+        for l in lignes:
+            yield json.dumps({
+                "nom": l.nom, "date": l.report_date.isoformat(), "village": l.village,
+                "rapport_id": l.report_id, "section": l.section
+            }, ensure_ascii=False) + "\n"
+
+    resp = current_app.response_class(generer(), mimetype="application/x-ndjson")
+    if suivant:
+        resp.headers["X-Next-Cursor"] = suivant
+    return resp
 
 # ---------- API Organisations ----------
-@app.route("/api/organisations")
+@bp.route("/api/organisations")
 @login_required
 def api_organisations():
     require_prevot_or_admin()
     organisations = Organisation.query.order_by(Organisation.nom_complet.asc()).all()
-    return jsonify([
-        {
-            "id": o.id,
-            "nom_complet": o.nom_complet,
-            "nom_abrege": o.nom_abrege
-        } for o in organisations
-    ])
+    return jsonify([organisation_to_json(o) for o in organisations])
 
-@app.route("/api/organisations", methods=["POST"])
+@bp.route("/api/organisations", methods=["POST"])
 @login_required
 def create_organisation():
     require_prevot_or_admin()
@@ -1005,17 +2967,15 @@ def create_organisation():
     )
     try:
         db.session.add(org)
+        incrementer_version("brigand", "organisation")
         db.session.commit()
-        return jsonify({"success": True, "id": org.id, "organisation": {
-            "id": org.id,
-            "nom_complet": org.nom_complet,
-            "nom_abrege": org.nom_abrege
-        }})
+        index_noms.invalider()
+        return jsonify({"success": True, "id": org.id, "organisation": organisation_to_json(org)})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/organisations/<int:org_id>", methods=["PUT"])
+@bp.route("/api/organisations/<int:org_id>", methods=["PUT"])
 @login_required
 def update_organisation(org_id):
     require_prevot_or_admin()
@@ -1032,30 +2992,34 @@ def update_organisation(org_id):
         na = (data.get("nom_abrege") or "").strip()
         org.nom_abrege = na or None
     try:
+        incrementer_version("brigand", "organisation")
         db.session.commit()
-        return jsonify({"success": True, "organisation": {
-            "id": org.id,
-            "nom_complet": org.nom_complet,
-            "nom_abrege": org.nom_abrege
-        }})
+        index_noms.invalider()
+        return jsonify({"success": True, "organisation": organisation_to_json(org)})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/organisations/<int:org_id>", methods=["DELETE"])
+@bp.route("/api/organisations/<int:org_id>", methods=["DELETE"])
 @login_required
 def delete_organisation(org_id):
     require_prevot_or_admin()
-    org = Organisation.query.get(org_id)
-    if not org:
-        return jsonify({"error": "Organisation introuvable"}), 404
     try:
-        db.session.delete(org)
-        # Optionnel : nettoyer les brigands pointant vers cette organisation
-        for b in Brigand.query.filter_by(organisation_id=org.id).all():
-            b.organisation_id = None
+        detaches = db.session.execute(
+            update(Brigand).where(Brigand.organisation_id == org_id).values(organisation_id=None),
+            execution_options={"synchronize_session": False}
+        ).rowcount
+        supprimees = db.session.execute(
+            delete(Organisation).where(Organisation.id == org_id),
+            execution_options={"synchronize_session": False}
+        ).rowcount
+        if not supprimees:
+            db.session.rollback()
+            return jsonify({"error": "Organisation introuvable"}), 404
+        incrementer_version("brigand", "organisation")
         db.session.commit()
-        return jsonify({"success": True})
+        index_noms.invalider()
+        return jsonify({"success": True, "brigands_detaches": detaches})
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -1063,5 +3027,30 @@ def delete_organisation(org_id):
 # ---------------------------------------------------------------------
 # Lancement
 # ---------------------------------------------------------------------
+def create_app(verifier=True):
+    # verifier=False : manage.py migrate / initdb, qui mettent eux-mêmes le schéma à jour
+    app = Flask(__name__, static_folder="static")
+    app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-secret")
+    app.config["SQLALCHEMY_DATABASE_URI"] = pg_uri(db_url)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options_moteur(app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=7)
+    app.config["REMEMBER_COOKIE_DURATION"] = timedelta(days=365)
+    app.config["REMEMBER_COOKIE_REFRESH_EACH_REQUEST"] = True
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    if verifier:
+        with app.app_context():
+            verifier_schema()
+    return app
+
+def __getattr__(nom):
+    # « main.app » (gunicorn main:app, manage.py) : application créée au premier accès
+    if nom == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {nom!r}")
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
+    create_app().run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
@@ -1,19 +1,33 @@
 import click
-from main import db, User, Village, app
+from main import db, User, Village
 
 @click.group()
 def cli(): pass
 
+def application(verifier=True):
+    # Créée par les seules commandes qui touchent la base (import de main sans effet de bord)
+    from main import create_app
+    return create_app(verifier=verifier)
+
 @cli.command("initdb")
 def initdb():
-    with app.app_context(): db.create_all(); print("DB initialisée.")
+    from main import migrer
+    with application(verifier=False).app_context(): v=migrer(); print(f"DB initialisée (schéma version {v}).")
+
+@cli.command("migrate")
+def migrate():
+    """Applique les migrations de schéma en attente (à lancer à chaque déploiement)."""
+    from main import migrer, version_schema, SCHEMA_VERSION
+    with application(verifier=False).app_context():
+        avant=version_schema(); apres=migrer()
+        print(f"Schéma : version {avant} -> {apres} (attendue {SCHEMA_VERSION}).")
 
 @cli.command("create-superadmin")
 @click.argument("username")
 @click.argument("password")
 def create_superadmin(username,password):
     from main import User, db
-    with app.app_context():
+    with application().app_context():
         u=User.query.filter_by(username=username).first()
         if u: print("Existe déjà."); return
         u=User(username=username,role="superadmin")
@@ -24,11 +38,263 @@ def create_superadmin(username,password):
 @click.argument("villages")
 def add_villages(villages):
     names=[v.strip() for v in villages.split(";") if v.strip()]
-    from main import Village, db
-    with app.app_context():
+    from main import Village, db, cache
+    with application().app_context():
         for n in names:
-            if not Village.query.filter_by(name=n).first():
-                db.session.add(Village(name=n))
-        db.session.commit(); print("Villages ajoutés:",", ".join(names))
+            if not Village.query.filter_by(nom=n).first():
+                db.session.add(Village(nom=n))
+        db.session.commit(); cache.invalider("villages"); print("Villages ajoutés:",", ".join(names))
+
+def _rapport_synthetique(n):
+    # Rapport factice de n lignes réparties comme un rapport réel (villageois majoritaires)
+    noms=[f"Villageois{i}" for i in range(n)]
+    part=max(n//10,1)
+    return dict(
+        mem_visions="\n".join(f"{x} | surveillance | a&c" for x in noms[:part]),
+        surveillance="\n".join(f"{x} | liste noire | LLG | Pillage | en prison | a&c" for x in noms[part:2*part]),
+        flux="\n".join(noms[2*part:3*part]),
+        etrangers="\n".join(noms[3*part:4*part]),
+        ac_presence="\n".join(noms[4*part:5*part]),
+        armies_groups="\n".join(f"Armée de {x}" for x in noms[5*part:6*part]),
+        villagers="\n".join(noms[6*part:]),
+        moves="",
+    )
+
+@cli.command("bench-rendu")
+@click.option("--lignes","-n",multiple=True,type=int,default=(1000,10000))
+@click.option("--repetitions","-r",default=5)
+def bench_rendu(lignes,repetitions):
+    import time
+    from datetime import date
+    from main import bbcode_report
+    with application().app_context():
+        for n in lignes:
+            r=_rapport_synthetique(n)
+            bbcode_report("Auch",date.today(),**r)
+            t=time.perf_counter()
+            for _ in range(repetitions):
+                bbcode_report("Auch",date.today(),**r)
+            ms=(time.perf_counter()-t)*1000/repetitions
+            print(f"{n:>6} lignes : {ms:8.2f} ms/rapport")
+
+@cli.command("check-requetes")
+@click.option("--tailles","-n",multiple=True,type=int,default=(10,200))
+def check_requetes(tailles):
+    # Le nombre d'instructions SQL de la sérialisation des brigands ne doit pas dépendre de leur nombre
+    from main import (Brigand, Organisation, compter_requetes, requete_brigands, brigand_ligne_to_json,
+                      requete_brigands_entites, brigands_to_json)
+    with application().app_context():
+        mesures={}
+        for n in tailles:
+            orgs=[Organisation(nom_complet=f"Org {i}") for i in range(max(n//5,1))]
+            db.session.add_all(orgs); db.session.flush()
+            db.session.add_all([Brigand(nom=f"Brigand {i}",organisation_id=orgs[i%len(orgs)].id) for i in range(n)])
+            db.session.flush(); db.session.expunge_all()
+            with compter_requetes() as lignes:
+                [brigand_ligne_to_json(l) for l in requete_brigands().all()]
+            with compter_requetes() as entites:
+                brigands_to_json(requete_brigands_entites().all())
+            mesures[n]=(lignes[0],entites[0])
+            db.session.rollback()
+            print(f"{n:>5} brigands : projection {lignes[0]} requête(s), entités {entites[0]} requête(s)")
+        if len(set(mesures.values()))>1:
+            raise SystemExit("ÉCHEC : le nombre de requêtes dépend du nombre de brigands.")
+        print("OK : nombre de requêtes constant.")
+
+GUIDE_EXEMPLE = """# Guide maréchal
+
+## Dépôt du rapport
+Chaque **maréchal** dépose son rapport avant *3h00*. Voir https://www.renaissancekingdoms.com pour le jeu.
+
+| Section | Format |
+|---|---|
+| Mémoire et visions | `Nom | typologie | A&C` |
+| Surveillance | `Nom | typologie | organisation | faits | statut | A&C` |
+
+1. Choisir le village
+2. Coller la liste des villageois
+3. Générer le rapport
+
+> Astuce : les noms connus sont colorés automatiquement.
+
+```
+Bidule | liste noire | LLG | Pillage | en prison
+```
+<script>alert("x")</script>
+"""
+
+@cli.command("bench-guides")
+@click.option("--duree","-d",default=2.0,help="Durée de mesure en secondes")
+def bench_guides(duree):
+    import time
+    from main import render_markdown_safe
+    texte=GUIDE_EXEMPLE*5
+    render_markdown_safe(texte)
+    n=0; debut=time.perf_counter()
+    while time.perf_counter()-debut<duree:
+        render_markdown_safe(texte); n+=1
+    print(f"{n/(time.perf_counter()-debut):.1f} rendus de guide / s ({len(texte)} caractères)")
+
+@cli.command("vider-depots")
+@click.option("--reprendre",is_flag=True,help="Remet en file les dépôts restés « en_cours » (processus interrompu)")
+def vider_depots_cmd(reprendre):
+    from main import DepotEnAttente, vider_depots, is_blocked_now
+    with application().app_context():
+        if is_blocked_now():
+            print("Créneau de maintenance en cours : rien n'est enregistré."); return
+        if reprendre:
+            n=DepotEnAttente.query.filter_by(statut="en_cours").update({"statut":"en_attente"}); db.session.commit()
+            print(f"{n} dépôt(s) remis en file.")
+        total=0
+        while True:
+            n=vider_depots()
+            if not n: break
+            total+=n
+        print(f"{total} dépôt(s) enregistré(s).")
+
+@cli.command("rebuild-agregats")
+@click.option("--lot",default=500,show_default=True,help="Rapports lus par lot")
+def rebuild_agregats(lot):
+    """Reconstruit agregat_garde, report_entry et synthese_jour depuis les rapports (premier rapport du jour = celui qui fait foi).
+    Les rapports dont le rendu asynchrone n'est pas passé sont laissés à leur tâche, qui les dérivera."""
+    from main import (A_DERIVER, Report, AgregatGarde, SyntheseJour, ReportEntry, valeurs_agregat, personnes_rapport, normaliser_nom,
+                      _fusionner, analyser_rapport, lignes_entrees, reperer_noms)
+    from sqlalchemy import insert
+    from sqlalchemy.orm import load_only
+    with application().app_context():
+        AgregatGarde.query.delete(); SyntheseJour.query.delete(); ReportEntry.query.delete()
+        nb_entrees=0
+        vus={}; synthese={}
+        q=(Report.query.options(load_only(Report.id,Report.village,Report.report_date,Report.user_id,Report.tour_de_garde,
+                                          *(getattr(Report,c) for c in ("mem_visions","surveillance","flux","etrangers",
+                                                                        "ac_presence","armies_groups","villagers","moves"))))
+           .filter(Report.rendu_statut.notin_(A_DERIVER)).order_by(Report.id).yield_per(lot))
+        for r in q:
+            analyse=analyser_rapport(r.mem_visions,r.surveillance)
+            noms=reperer_noms(r)
+            entrees=lignes_entrees(r,analyse)
+            if entrees: db.session.execute(insert(ReportEntry),entrees); nb_entrees+=len(entrees)
+            for p in personnes_rapport(r,analyse,noms):
+                cle=(r.report_date,normaliser_nom(p["nom"]))
+                if cle not in synthese:
+                    synthese[cle]=SyntheseJour(report_date=r.report_date,nom=p["nom"],nom_normalise=cle[1],
+                                               typologie="",organisation="",statut="",villages="[]")
+                _fusionner(synthese[cle],p)
+            cle=(r.report_date,r.village)
+            if cle in vus: vus[cle]["nb_rapports"]+=1; continue
+            vus[cle]=dict(report_date=r.report_date,village=r.village,rapport_id=r.id,user_id=r.user_id,
+                          tour_de_garde=r.tour_de_garde,nb_rapports=1,**valeurs_agregat(r,noms))
+        lignes=list(vus.values())
+        for i in range(0,len(lignes),lot):
+            db.session.bulk_insert_mappings(AgregatGarde,lignes[i:i+lot])
+        db.session.add_all(synthese.values())
+        db.session.commit(); print(f"{len(lignes)} agrégat(s), {nb_entrees} entrée(s), {len(synthese)} ligne(s) de synthèse reconstruit(s).")
+
+@cli.command("backfill-observations")
+@click.option("--lot",default=500,show_default=True,help="Rapports lus par lot")
+def backfill_observations(lot):
+    """Remplit la table observation (historique des passages) pour les rapports existants."""
+    from main import Report, Observation, analyser_rapport, lignes_observations, A_DERIVER
+    from sqlalchemy import insert
+    from sqlalchemy.orm import load_only
+    with application().app_context():
+        Observation.query.delete()
+        n=0
+        q=(Report.query.options(load_only(Report.id,Report.village,Report.report_date,Report.mem_visions,
+                                          Report.surveillance,Report.villagers,Report.armies_groups))
+           .filter(Report.rendu_statut.notin_(A_DERIVER)).order_by(Report.id).yield_per(lot))
+        tampon=[]
+        for r in q:
+            tampon.extend(lignes_observations(r,analyser_rapport(r.mem_visions,r.surveillance)))
+            if len(tampon)>=lot*10:
+                db.session.execute(insert(Observation),tampon); n+=len(tampon); tampon=[]
+        if tampon: db.session.execute(insert(Observation),tampon); n+=len(tampon)
+        db.session.commit(); print(f"{n} observation(s) enregistrée(s).")
+
+@cli.command("bench-login")
+@click.option("--methode",multiple=True,help="Méthode(s) werkzeug à comparer (défaut : PASSWORD_HASH_METHOD)")
+@click.option("--clients",default=16,show_default=True,help="Connexions simultanées simulées")
+@click.option("--n",default=64,show_default=True,help="Vérifications par mesure")
+def bench_login(methode,clients,n):
+    """Vérifications de mot de passe par seconde et par worker, en direct et via le pool borné."""
+    from concurrent.futures import ThreadPoolExecutor
+    from time import perf_counter
+    from werkzeug.security import generate_password_hash, check_password_hash
+    import main
+    for m in methode or (main.PASSWORD_HASH_METHOD,):
+        h=generate_password_hash("secret",method=m)
+        t=perf_counter()
+        for _ in range(max(n//8,4)): check_password_hash(h,"secret")
+        seq=max(n//8,4)/(perf_counter()-t)
+        t=perf_counter(); refus=0
+        with ThreadPoolExecutor(max_workers=clients) as ex:
+            for ok in ex.map(lambda _: main.verifier_mot_de_passe(h,"secret"),range(n)):
+                refus+=ok is None
+        par=(n-refus)/(perf_counter()-t)
+        print(f"{m:>24} : {seq:7.1f}/s en série, {par:7.1f}/s via le pool ({main.LOGIN_WORKERS} threads, {clients} clients, {refus} refus 503)")
+
+@cli.command("bench-import")
+@click.option("--repetitions",default=5,show_default=True)
+@click.option("--top",default=8,show_default=True,help="Modules les plus coûteux affichés")
+def bench_import(repetitions,top):
+    """Coût de démarrage mesuré dans un processus neuf (python -X importtime) :
+    import de main seul, puis import + création de l'application."""
+    import subprocess, sys, statistics
+    from pathlib import Path
+    racine=str(Path(__file__).resolve().parent)
+    def mesurer(code):
+        totaux=[]; modules={}
+        for _ in range(repetitions):
+            res=subprocess.run([sys.executable,"-X","importtime","-c",code],cwd=racine,capture_output=True,text=True)
+            if res.returncode: raise SystemExit(res.stderr[-2000:])
+            lignes=[l for l in res.stderr.splitlines() if l.startswith("import time:") and "|" in l]
+            for l in lignes[1:]:
+                _,cumul,nom=[x.strip() for x in l[len("import time:"):].split("|")]
+                if not nom.startswith(" ") and "." not in nom: modules.setdefault(nom,[]).append(int(cumul))
+            totaux.append(float(res.stdout.strip() or 0))
+        return statistics.median(totaux),modules
+    horloge="import time; t=time.perf_counter(); {}; print((time.perf_counter()-t)*1000)"
+    for titre,code in (("import main","import main"),
+                       ("import main + app","import main; main.app")):
+        ms,modules=mesurer(horloge.format(code))
+        print(f"{titre:>18} : {ms:7.1f} ms (médiane sur {repetitions})")
+        lourds=sorted(((statistics.median(v)/1000,k) for k,v in modules.items()),reverse=True)[:top]
+        print("                     "+", ".join(f"{k} {v:.0f} ms" for v,k in lourds))
+
+@cli.command("check-horloge")
+@click.option("--debut",default=None,help="Début du créneau bloqué (défaut : BLOCK_DEPOSITS_FROM)")
+@click.option("--fin",default=None,help="Fin du créneau bloqué (défaut : BLOCK_DEPOSITS_TO)")
+def check_horloge(debut,fin):
+    """Compare HorlogeJeu (horloge factice) au calcul direct sur l'heure murale, par quart d'heure sur un an."""
+    from datetime import datetime, timedelta
+    from main import HorlogeJeu, TZ, BLOCK_FROM, BLOCK_TO, parse_hhmm
+    debut,fin=debut or BLOCK_FROM, fin or BLOCK_TO
+    d,f=parse_hhmm(debut),parse_hhmm(fin)
+    instant=[TZ.localize(datetime(2025,1,1))]
+    h=HorlogeJeu(TZ,debut,fin,maintenant=lambda: instant[0])
+    calculs=[0]; calculer=h._calculer
+    def compte(now):
+        calculs[0]+=1; return calculer(now)
+    h._calculer=compte
+    erreurs=n=0
+    while instant[0].year==2025:
+        local=instant[0].astimezone(TZ); t=local.time()
+        try:
+            TZ.localize(local.replace(tzinfo=None),is_dst=None)
+        except Exception:
+            # Heure répétée : l'heure murale seule ne dit pas de quel passage il s'agit
+            instant[0]+=timedelta(minutes=15); continue
+        bloque=d<=t<f if d<f else (t>=d or t<f)
+        jour=local.date() if t>=f else local.date()-timedelta(days=1)
+        suivant=jour+timedelta(days=1)
+        for _ in range(3):
+            e=h.etat()
+            if (e.jour,e.bloque,e.jour_suivant)!=(jour,bloque,suivant):
+                erreurs+=1
+                if erreurs<=5: print("écart",local.isoformat(),e,(jour,bloque,suivant))
+            n+=1
+        instant[0]+=timedelta(minutes=15)
+    print(f"{n} lectures, {calculs[0]} calculs de bornes, {erreurs} écart(s)")
+    if erreurs: raise SystemExit(1)
 
 if __name__=="__main__": cli()
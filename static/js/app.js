@@ -1,10 +1,19 @@
 const DOM = {};
 
+// Liste paginée : chaque page porte un ETag, le navigateur la revalide (304 si inchangée)
 async function apiGetBrigands() {
-  const res = await fetch("/api/brigands");
-  const json = await res.json();
-  if (!res.ok) throw new Error(json.error || "Erreur lors du chargement des brigands");
-  return json;
+  const brigands = [];
+  let cursor = null;
+  do {
+    const params = new URLSearchParams({ limit: "500" });
+    if (cursor) params.set("cursor", cursor);
+    const res = await fetch(`/api/brigands?${params}`);
+    const json = await res.json();
+    if (!res.ok) throw new Error(json.error || "Erreur lors du chargement des brigands");
+    brigands.push(...json.items);
+    cursor = json.next_cursor;
+  } while (cursor);
+  return brigands;
 }
 
 async function apiGetOrganisations() {